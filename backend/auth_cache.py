@@ -0,0 +1,81 @@
+"""
+Cache dos usuários autenticados (header X-User-Email).
+
+Guarda apenas o necessário para autorização (id, role, is_active) de usuários
+ativos, em um LRU limitado com TTL. As rotas de administração de usuários
+invalidam a entrada assim que alteram o usuário; o TTL limita o tempo em que
+outros processos (workers) podem ver uma entrada antiga.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from models import UserRole
+
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))  # Segundos; 0 desliga o cache
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "1024"))
+
+
+class Principal(NamedTuple):
+    """Usuário autenticado, sem vínculo com a sessão do banco"""
+    id: int
+    email: str
+    role: UserRole
+    is_active: bool
+
+
+class PrincipalCache:
+    """LRU de (email -> Principal) com expiração por TTL"""
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = AUTH_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        """Muda a cada invalidação; leituras do banco anteriores a ela não entram no cache"""
+        return self._generation
+
+    def get(self, email: str) -> Optional[Principal]:
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            expires_at, principal = entry
+            if expires_at <= time.monotonic():
+                del self._entries[email]
+                return None
+            self._entries.move_to_end(email)
+            return principal
+
+    def put(self, principal: Principal, generation: int):
+        """Guarda principal se nenhuma invalidação ocorreu desde a leitura (generation)"""
+        if self.ttl <= 0 or not principal.is_active:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[principal.email] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(principal.email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: int):
+        """Remove as entradas do usuário (por id, pois o email pode ter mudado)"""
+        with self._lock:
+            self._generation += 1
+            for email in [email for email, (_, principal) in self._entries.items() if principal.id == user_id]:
+                del self._entries[email]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
@@ -0,0 +1,84 @@
+"""
+Utilitários compartilhados pelos scripts de benchmark/stress.
+
+Os scripts falam HTTP com a API (--url) ou, sem --url, sobem o backend em uma
+thread local (uvicorn) usando DATABASE_URL ou um SQLite temporário.
+"""
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Optional, Tuple
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_EMAIL = "admin@admin.com"
+
+
+class ApiClient:
+    """Cliente HTTP mínimo (urllib) autenticado pelo header X-User-Email"""
+
+    def __init__(self, base_url: str, email: str = ADMIN_EMAIL):
+        self.base_url = base_url.rstrip("/")
+        self.email = email
+
+    def request(self, method: str, path: str, body=None, headers: Optional[dict] = None) -> Tuple[int, object, dict]:
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        request.add_header("X-User-Email", self.email)
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            request.add_header(name, value)
+
+        try:
+            with urllib.request.urlopen(request, timeout=300) as response:
+                status, raw, response_headers = response.status, response.read(), dict(response.headers)
+        except urllib.error.HTTPError as e:
+            status, raw, response_headers = e.code, e.read(), dict(e.headers)
+
+        try:
+            payload = json.loads(raw) if raw else None
+        except ValueError:
+            payload = raw
+        return status, payload, response_headers
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, body=None, **kwargs):
+        return self.request("POST", path, body, **kwargs)
+
+    def delete(self, path: str, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_local_server() -> str:
+    """Sobe o backend em uma thread e retorna a URL base"""
+    if "DATABASE_URL" not in os.environ:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="ipam-bench-"), "ipam.db")
+        os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    sys.path.insert(0, BACKEND_DIR)
+
+    import uvicorn
+    import main
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    print(f"🚀 Backend local em http://127.0.0.1:{port} ({os.environ['DATABASE_URL']})")
+    return f"http://127.0.0.1:{port}"
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark de concorrência com requisições lentas e rápidas misturadas
+Uso: python benchmarks/concurrency.py [--url http://localhost:8000] [--prefixes 20000] [--duration 10]
+
+Mede a latência das requisições rápidas (GET /prefixes/{id}) sozinhas e
+depois enquanto outras threads fazem requisições lentas (GET /prefixes com
+todos os prefixos). Se uma requisição lenta bloqueia o worker, a latência
+das rápidas sobe junto com a duração das lentas.
+"""
+
+import argparse
+import ipaddress
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from common import ApiClient, start_local_server
+
+
+def seed(client: ApiClient, count: int) -> list:
+    """Cria count /24 dentro de 10.0.0.0/8 via importação em lote; retorna os ids"""
+    base = ipaddress.ip_network("10.0.0.0/8")
+    rows = [{"prefix": "10.0.0.0/8", "description": "bench"}] + [
+        {"prefix": str(subnet), "description": "bench"}
+        for subnet in list(base.subnets(new_prefix=24))[:count]
+    ]
+    status, payload, _ = client.post("/prefixes/bulk", rows)
+    if status != 200:
+        raise SystemExit(f"❌ Falha ao popular o banco: {payload}")
+    _, prefixes, _ = client.get("/prefixes")
+    return [prefix["id"] for prefix in prefixes]
+
+
+def run_phase(client: ApiClient, ids: list, fast_threads: int, slow_threads: int, duration: float) -> dict:
+    """Dispara as threads por duration segundos; retorna as latências por tipo de requisição"""
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    deadline = time.perf_counter() + duration
+
+    def loop(kind: str, seed_value: int):
+        rnd = random.Random(seed_value)
+        while time.perf_counter() < deadline:
+            path = "/prefixes" if kind == "lenta" else f"/prefixes/{rnd.choice(ids)}"
+            started = time.perf_counter()
+            status, _, _ = client.get(path)
+            elapsed = time.perf_counter() - started
+            if status == 200:
+                latencies[kind].append(elapsed)
+            else:
+                errors[kind] += 1
+
+    threads = [threading.Thread(target=loop, args=("rápida", i)) for i in range(fast_threads)]
+    threads += [threading.Thread(target=loop, args=("lenta", 1000 + i)) for i in range(slow_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {"latencies": latencies, "errors": errors}
+
+
+def report(title: str, result: dict, duration: float):
+    print(f"\n📊 {title}")
+    for kind, values in sorted(result["latencies"].items()):
+        values.sort()
+        p95 = values[int(len(values) * 0.95)]
+        p99 = values[int(len(values) * 0.99)]
+        print(
+            f"   {kind:<7} {len(values) / duration:8.1f} req/s  "
+            f"p50 {statistics.median(values) * 1000:8.1f} ms  p95 {p95 * 1000:8.1f} ms  "
+            f"p99 {p99 * 1000:8.1f} ms  max {values[-1] * 1000:8.1f} ms"
+        )
+    for kind, count in result["errors"].items():
+        print(f"   {kind:<7} {count} erro(s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de requisições lentas e rápidas concorrentes")
+    parser.add_argument("--url", help="URL da API (sem --url sobe um backend local)")
+    parser.add_argument("--prefixes", type=int, default=20000, help="Prefixos criados (lista lenta)")
+    parser.add_argument("--fast-threads", type=int, default=8)
+    parser.add_argument("--slow-threads", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="Segundos por fase")
+    args = parser.parse_args()
+
+    client = ApiClient(args.url or start_local_server())
+    ids = seed(client, args.prefixes)
+    print(f"🌱 {len(ids)} prefixos")
+
+    report("Só requisições rápidas", run_phase(client, ids, args.fast_threads, 0, args.duration), args.duration)
+    report(
+        f"Rápidas + {args.slow_threads} thread(s) de requisições lentas",
+        run_phase(client, ids, args.fast_threads, args.slow_threads, args.duration),
+        args.duration
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Benchmark reprodutível dos caminhos críticos do IPAM
+Uso: python benchmarks/hot_paths.py [--sizes 1000,10000,100000] [--output resultado.json] [--compare base.json]
+
+Gera árvores sintéticas de prefixos (mistura IPv4/IPv6, profundidade e
+densidade de "usado" configuráveis, sempre a partir da mesma seed) em um
+SQLite temporário e mede, chamando as funções do backend diretamente:
+
+  - find_parent: pai mais específico no banco (most_specific_parent_id)
+  - build_subnet_hierarchy: árvore completa com sub-redes calculadas (modos binary e compact)
+  - serialize_hierarchy: codificação JSON da árvore completa (fast_json.dumps)
+  - calculate_prefix_summary: sumarização a partir dos rollups
+  - create_intermediate_prefixes: criação com hierarquia (+ rollups), desfeita com rollback
+  - divide_prefix: divisão em sub-redes (+ rollups), desfeita com rollback
+
+O resultado (mediana/mínimo por operação e por tamanho) vai para um JSON com
+o commit atual; --compare mostra a variação contra um JSON anterior. Para 1M
+prefixos use --sizes 1000000 (leva alguns minutos e alguns GB de memória).
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Máscaras de cada nível da árvore sintética, por família
+LEVELS = {4: (8, 16, 20, 24, 28), 6: (32, 40, 48, 56, 64)}
+ROOT_CAPACITY = 100000  # Prefixos por raiz antes de abrir outra
+INSERT_BATCH_SIZE = 10000
+
+
+def generate_tree(size: int, ipv6_ratio: float, depth: int, usado_density: float, seed: int) -> list:
+    """Linhas (id, parent_id, network) de uma árvore sintética, com ids sequenciais a partir de 1"""
+    rnd = random.Random(seed)
+    rows = []
+    family_sizes = {6: int(size * ipv6_ratio)}
+    family_sizes[4] = size - family_sizes[6]
+
+    for version, family_size in family_sizes.items():
+        levels = LEVELS[version][:depth]
+        max_bits = 32 if version == 4 else 128
+        base = int(ipaddress.ip_address("10.0.0.0" if version == 4 else "2001:db8::"))
+        open_nodes = []  # (id, start, nível, filhos já usados)
+        roots = 0
+
+        for index in range(family_size):
+            if not open_nodes or index % ROOT_CAPACITY == 0:
+                # Nova raiz: 10.0.0.0/8, 11.0.0.0/8... ou 2001:db8::/32, 2001:db9::/32...
+                start = base + (roots << (max_bits - levels[0]))
+                roots += 1
+                node = (len(rows) + 1, None, 0, start)
+            else:
+                slot = rnd.randrange(len(open_nodes))
+                parent_id, parent_start, level, used = open_nodes[slot]
+                step = levels[level + 1] - levels[level]
+                child = rnd.randrange(1 << step)
+                while child in used:
+                    child = rnd.randrange(1 << step)
+                used.add(child)
+                if len(used) == 1 << step:
+                    open_nodes[slot] = open_nodes[-1]
+                    open_nodes.pop()
+                start = parent_start + (child << (max_bits - levels[level + 1]))
+                node = (len(rows) + 1, parent_id, level + 1, start)
+
+            prefix_id, parent_id, level, start = node
+            network = ipaddress.ip_network((start, levels[level]))
+            rows.append((prefix_id, parent_id, network, level, rnd.random() < usado_density))
+            if level + 1 < len(levels):
+                open_nodes.append((prefix_id, start, level, set()))
+
+    return rows
+
+
+def populate(db, rows: list, user_id: int):
+    """Substitui o conteúdo de ip_prefixes pela árvore gerada e recalcula os rollups"""
+    from models import IPPrefix, network_columns
+    from rollup import rebuild_all_rollups
+
+    db.query(IPPrefix).delete()
+    now = datetime.utcnow()
+    table = IPPrefix.__table__
+    conn = db.connection()
+    for offset in range(0, len(rows), INSERT_BATCH_SIZE):
+        conn.execute(table.insert(), [
+            {
+                "id": prefix_id,
+                "prefix": str(network),
+                "description": f"Bench {network}",
+                "usado": usado,
+                "is_auto_created": False,
+                "parent_id": parent_id,
+                "is_ipv6": network.version == 6,
+                "user_id": user_id,
+                "created_at": now,
+                "updated_at": now,
+                **network_columns(network),
+            }
+            for prefix_id, parent_id, network, _, usado in rows[offset:offset + INSERT_BATCH_SIZE]
+        ])
+    rebuild_all_rollups(db)
+    db.commit()
+    db.expunge_all()
+
+
+def timed(func, repeat: int, operations: int = 1) -> dict:
+    """Executa func repeat vezes; tempos em segundos por execução e por operação"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    median = statistics.median(samples)
+    return {
+        "median_s": round(median, 6),
+        "min_s": round(min(samples), 6),
+        "operations": operations,
+        "per_op_us": round(median / operations * 1e6, 2),
+    }
+
+
+def run_size(size: int, args) -> dict:
+    from database import SessionLocal
+    from divide import divide_prefix_subnets
+    from fast_json import dumps
+    from hierarchy import build_subnet_hierarchy
+    from locks import most_specific_parent_id
+    from main import calculate_prefix_summary, create_intermediate_prefixes
+    from models import IPPrefix, User
+    from rollup import refresh_rollups
+
+    rnd = random.Random(args.seed)
+    print(f"\n🌱 Gerando {size} prefixos...", flush=True)
+    started = time.perf_counter()
+    rows = generate_tree(size, args.ipv6_ratio, args.depth, args.usado, args.seed)
+    db = SessionLocal()
+    user_id = db.query(User.id).first()[0]
+    populate(db, rows, user_id)
+    print(f"   pronto em {time.perf_counter() - started:.1f}s", flush=True)
+
+    results = {}
+
+    # Redes pequenas dentro de prefixos aleatórios (consultas de pai)
+    queries = []
+    for _ in range(args.queries):
+        _, _, network, _, _ = rows[rnd.randrange(len(rows))]
+        target_len = network.max_prefixlen - 2 if network.version == 4 else 96
+        offset = rnd.randrange(network.num_addresses >> (network.max_prefixlen - target_len))
+        queries.append(ipaddress.ip_network(
+            (int(network.network_address) + (offset << (network.max_prefixlen - target_len)), target_len)
+        ))
+
+    results["find_parent_db"] = timed(
+        lambda: [most_specific_parent_id(db, network) for network in queries], args.repeat, len(queries)
+    )
+
+    prefixes = []
+
+    def load():
+        db.expunge_all()
+        prefixes[:] = db.query(IPPrefix).all()
+
+    results["load_prefixes"] = timed(load, args.repeat, size)
+    results["build_subnet_hierarchy"] = timed(lambda: build_subnet_hierarchy(prefixes), args.repeat, size)
+    results["build_subnet_hierarchy_compact"] = timed(
+        lambda: build_subnet_hierarchy(prefixes, mode="compact"), args.repeat, size
+    )
+    hierarchy = build_subnet_hierarchy(prefixes)
+    results["serialize_hierarchy"] = timed(lambda: dumps(hierarchy), args.repeat, size)
+    hierarchy = None
+    results["calculate_prefix_summary"] = timed(lambda: calculate_prefix_summary(prefixes), args.repeat, size)
+
+    # Soltar a árvore carregada: o rollback expiraria todos os objetos da sessão
+    prefixes.clear()
+    db.expunge_all()
+
+    # Alvos /30 (ou /96) ainda inexistentes dentro de prefixos aleatórios
+    targets = queries[:args.writes]
+
+    def create_intermediates():
+        for network in targets:
+            target_id = create_intermediate_prefixes(db, network, "Bench", False, user_id)
+            refresh_rollups(db, [target_id])
+            db.rollback()
+
+    results["create_intermediate_prefixes"] = timed(create_intermediates, args.repeat, len(targets))
+
+    # Divisão em até 256 sub-redes de prefixos aleatórios
+    to_divide = [rows[rnd.randrange(len(rows))] for _ in range(args.writes)]
+
+    def divide():
+        for prefix_id, _, network, _, _ in to_divide:
+            prefix = db.get(IPPrefix, prefix_id)
+            target_mask = min(network.prefixlen + 8, network.max_prefixlen)
+            divide_prefix_subnets(db, prefix, target_mask, None, user_id)
+            db.rollback()
+
+    results["divide_prefix"] = timed(divide, args.repeat, len(to_divide))
+    db.close()
+
+    for operation, result in results.items():
+        print(f"   {operation:<30} mediana {result['median_s'] * 1000:10.2f} ms  ({result['per_op_us']:.2f} µs/op)")
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(current: dict, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n📈 Comparação com {baseline_path} (commit {baseline['meta'].get('commit')})")
+    for size, operations in current["results"].items():
+        for operation, result in operations.items():
+            before = baseline["results"].get(size, {}).get(operation)
+            if not before:
+                continue
+            change = (result["median_s"] - before["median_s"]) / before["median_s"] * 100 if before["median_s"] else 0
+            marker = "🔴" if change > 10 else "🟢" if change < -10 else "  "
+            print(f"   {marker} {size:>8} {operation:<30} {before['median_s'] * 1000:10.2f} ms -> "
+                  f"{result['median_s'] * 1000:10.2f} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos caminhos críticos do IPAM")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Tamanhos das árvores (ex: 1000,10000,100000,1000000)")
+    parser.add_argument("--ipv6-ratio", type=float, default=0.3, help="Fração de prefixos IPv6")
+    parser.add_argument("--depth", type=int, default=5, choices=range(2, 6), help="Níveis da árvore")
+    parser.add_argument("--usado", type=float, default=0.3, help="Fração de prefixos marcados como usados")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetições de cada medida (vale a mediana)")
+    parser.add_argument("--queries", type=int, default=1000, help="Consultas de pai por medida")
+    parser.add_argument("--writes", type=int, default=20, help="Criações/divisões por medida")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Arquivo JSON de resultado (padrão: benchmarks/results/hot_paths-<commit>.json)")
+    parser.add_argument("--compare", help="JSON de uma execução anterior para comparar")
+    args = parser.parse_args()
+
+    # Sempre um SQLite novo: o benchmark apaga e recria a tabela de prefixos
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='ipam-bench-'), 'ipam.db')}"
+    sys.path.insert(0, BACKEND_DIR)
+    import main as backend
+
+    asyncio.run(backend.startup_event())
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        },
+        "results": {str(size): run_size(size, args) for size in sizes},
+    }
+
+    path = args.output or os.path.join(BACKEND_DIR, "benchmarks", "results", f"hot_paths-{output['meta']['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"\n💾 Resultados em {path}")
+
+    if args.compare:
+        compare(output, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Teste de stress de alocação concorrente
+Uso: python benchmarks/stress_allocation.py [--url http://localhost:8000] [--threads 16] [--ops 200]
+
+Várias threads criam prefixos sobrepostos, promovem sub-redes calculadas e
+alocam blocos livres (disputando o pool com criações manuais) ao mesmo tempo. No fim confere:
+  - nenhum prefixo duplicado e nenhum bloco entregue a duas alocações;
+  - nenhuma escrita perdida (todo prefixo confirmado com 200 existe);
+  - nenhum parent_id desatualizado (nenhum pai mais específico criado antes);
+  - rollups coerentes (children_count e endereços usados batem com os filhos).
+"""
+
+import argparse
+import ipaddress
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from common import ApiClient, start_local_server
+
+
+def random_subnet(rnd: random.Random, base: ipaddress.IPv4Network) -> ipaddress.IPv4Network:
+    prefixlen = rnd.randint(base.prefixlen + 4, base.prefixlen + 12)
+    return ipaddress.ip_network(
+        (int(base.network_address) + rnd.randrange(base.num_addresses), prefixlen), strict=False
+    )
+
+
+def worker(client: ApiClient, base: ipaddress.IPv4Network, pool: ipaddress.IPv4Network, pool_id: int,
+           ops: int, seed: int) -> dict:
+    rnd = random.Random(seed)
+    result = {"status": Counter(), "created": {}, "allocated": []}
+
+    for _ in range(ops):
+        operation = rnd.random()
+        subnet = random_subnet(rnd, base)
+
+        if operation < 0.35:
+            path, body = f"/prefixes/{pool_id}/allocate", {
+                "prefixlen": rnd.randint(pool.prefixlen + 8, pool.prefixlen + 12),
+                "strategy": rnd.choice(["first", "best"])
+            }
+        elif operation < 0.5:
+            # Criações manuais disputando o mesmo pool das alocações
+            path, body = "/prefixes", {"prefix": str(random_subnet(rnd, pool)), "description": "stress"}
+        elif operation < 0.75:
+            path, body = "/prefixes", {"prefix": str(subnet), "description": "stress"}
+        elif operation < 0.95:
+            path, body = "/prefixes/create-from-calculated", {"prefix": str(subnet), "description": "stress"}
+        else:
+            path, body = "/prefixes/with-hierarchy", {"prefix": str(subnet), "description": "stress"}
+
+        status, payload, _ = client.post(path, body)
+        result["status"][(path.split("/")[-1] or "prefixes", status)] += 1
+        if status != 200:
+            continue
+        if path.endswith("/allocate"):
+            for prefix in payload["prefixes"]:
+                result["allocated"].append(prefix["prefix"])
+                result["created"][prefix["id"]] = prefix["prefix"]
+        else:
+            result["created"][payload["id"]] = payload["prefix"]
+
+    return result
+
+
+def verify(client: ApiClient, results: list) -> list:
+    """Confere as invariantes; retorna a lista de problemas encontrados"""
+    problems = []
+    _, prefixes, _ = client.get("/prefixes")
+    by_id = {p["id"]: p for p in prefixes}
+    networks = {p["id"]: ipaddress.ip_network(p["prefix"]) for p in prefixes}
+
+    duplicates = [prefix for prefix, count in Counter(p["prefix"] for p in prefixes).items() if count > 1]
+    if duplicates:
+        problems.append(f"prefixos duplicados: {duplicates[:5]}")
+
+    allocated = Counter(prefix for result in results for prefix in result["allocated"])
+    double_allocated = [prefix for prefix, count in allocated.items() if count > 1]
+    if double_allocated:
+        problems.append(f"blocos alocados mais de uma vez: {double_allocated[:5]}")
+
+    for result in results:
+        for prefix_id, prefix in result["created"].items():
+            if by_id.get(prefix_id, {}).get("prefix") != prefix:
+                problems.append(f"escrita perdida: {prefix} (id {prefix_id})")
+
+    children = defaultdict(list)
+    for prefix in prefixes:
+        network = networks[prefix["id"]]
+        parent_id = prefix["parent_id"]
+        if parent_id is not None:
+            children[parent_id].append(prefix)
+            if not network.subnet_of(networks[parent_id]) or network == networks[parent_id]:
+                problems.append(f"pai inválido: {prefix['prefix']} -> {by_id[parent_id]['prefix']}")
+                continue
+        parent_len = networks[parent_id].prefixlen if parent_id is not None else -1
+        # Um pai mais específico só é aceitável se foi criado depois (não há reparenting)
+        stale = [
+            other for other_id, other in networks.items()
+            if other_id < prefix["id"] and other.version == network.version
+            and other.prefixlen > parent_len and other != network and network.subnet_of(other)
+        ]
+        if stale:
+            problems.append(f"parent_id desatualizado: {prefix['prefix']} (deveria ser {stale[0]})")
+
+    _, summary, _ = client.get("/summary")
+    for row in summary:
+        prefix = next(p for p in prefixes if p["prefix"] == row["prefix"])
+        expected_children = children[prefix["id"]]
+        expected_used = sum(networks[child["id"]].num_addresses for child in expected_children)
+        if row["children_count"] != len(expected_children) or row["used_addresses"] != expected_used:
+            problems.append(
+                f"rollup desatualizado em {row['prefix']}: children_count={row['children_count']} "
+                f"(esperado {len(expected_children)}), used={row['used_addresses']} (esperado {expected_used})"
+            )
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress de alocação concorrente")
+    parser.add_argument("--url", help="URL da API (sem --url sobe um backend local)")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=200, help="Operações por thread")
+    parser.add_argument("--base", default="10.128.0.0/16", help="Espaço disputado pelas criações")
+    parser.add_argument("--pool", default="10.129.0.0/16", help="Espaço disputado pelas alocações")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    client = ApiClient(args.url or start_local_server())
+    base = ipaddress.ip_network(args.base)
+    pool = ipaddress.ip_network(args.pool)
+    for network in (base, pool):
+        status, payload, _ = client.post("/prefixes", {"prefix": str(network), "description": "stress base"})
+        if status != 200:
+            print(f"❌ Não foi possível criar o prefixo base {network}: {payload}")
+            sys.exit(1)
+    pool_id = payload["id"]
+
+    print(f"🚀 {args.threads} threads x {args.ops} operações em {base} e {pool}...")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        futures = [
+            executor.submit(worker, client, base, pool, pool_id, args.ops, args.seed * 1000 + i)
+            for i in range(args.threads)
+        ]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    total_ops = args.threads * args.ops
+    statuses = sum((result["status"] for result in results), Counter())
+    print(f"⏱️  {total_ops} operações em {elapsed:.2f}s ({total_ops / elapsed:.0f} ops/s)")
+    for (operation, status), count in sorted(statuses.items()):
+        print(f"   {operation:<24} HTTP {status}: {count}")
+
+    problems = verify(client, results)
+    if problems:
+        print(f"❌ {len(problems)} problema(s):")
+        for problem in problems[:20]:
+            print(f"   {problem}")
+        sys.exit(1)
+    print("✅ Sem duplicatas, sem escritas perdidas, pais e rollups coerentes")
+
+
+if __name__ == "__main__":
+    main()
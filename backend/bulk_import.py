@@ -0,0 +1,375 @@
+"""
+Importação em lote de prefixos (POST /prefixes/bulk).
+
+Todas as linhas são validadas antes de qualquer escrita. Como nas demais
+escritas, os pais já existentes das linhas são bloqueados (write_locks) antes
+de verificar existência e inserir, e são resolvidos no banco: as super-redes
+de todas as linhas, sem repetir as compartilhadas, são buscadas em lotes no
+índice único de prefix. As linhas novas são ordenadas por rede e tamanho de
+máscara, o que permite resolver os pais entre elas em um único passe com uma
+pilha de contêineres. A gravação é feita nível a nível da árvore nova
+(executemany, ou COPY no PostgreSQL) dentro da transação da sessão.
+"""
+
+import bisect
+import csv
+import io
+import ipaddress
+import json
+from datetime import datetime
+from typing import Dict, List, Optional
+from sqlalchemy import or_, select
+from sqlalchemy.orm import Session
+from models import IPPrefix, network_columns
+from free_space import free_space_index
+from locks import write_locks
+from reparent import adopt_children
+from rollup import IN_CHUNK_SIZE, refresh_rollups
+from schemas import BulkImportResponse, BulkImportRowResult
+
+MAX_BULK_ROWS = 100000
+
+TRUE_VALUES = {"true", "1", "sim", "yes", "s", "y", "x"}
+FALSE_VALUES = {"false", "0", "nao", "não", "no", "n", ""}
+
+COPY_COLUMNS = [
+    "prefix", "description", "usado", "is_auto_created", "parent_id", "is_ipv6",
+    "created_at", "updated_at", "user_id", "network_start", "network_end", "prefixlen", "cidr",
+]
+
+
+def parse_bulk_payload(body: bytes, content_type: Optional[str]) -> List[dict]:
+    """Converte o corpo (JSON ou CSV com cabeçalho) em uma lista de linhas"""
+    text = body.decode("utf-8-sig")
+
+    if content_type and "csv" in content_type:
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "prefix" not in [name.strip() for name in reader.fieldnames]:
+            raise ValueError("CSV header must contain a 'prefix' column")
+        rows = [{(key or "").strip(): value for key, value in row.items()} for row in reader]
+    else:
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        rows = data.get("prefixes") if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("Expected a list of objects or {\"prefixes\": [...]}")
+
+    if len(rows) > MAX_BULK_ROWS:
+        raise ValueError(f"Too many rows (max {MAX_BULK_ROWS})")
+    return rows
+
+
+def parse_usado(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return False
+    normalized = str(value).strip().lower()
+    if normalized in TRUE_VALUES:
+        return True
+    if normalized in FALSE_VALUES:
+        return False
+    raise ValueError(f"Invalid usado value: {value!r}")
+
+
+def import_prefixes(db: Session, rows: List[dict], user_id: int) -> BulkImportResponse:
+    """Valida, resolve os pais e insere as linhas; não faz commit"""
+    results = [None] * len(rows)
+    entries = []
+    seen = set()
+
+    # 1. Validação de todas as linhas
+    for index, row in enumerate(rows):
+        raw_prefix = str(row.get("prefix") or "").strip()
+        try:
+            network = ipaddress.ip_network(raw_prefix, strict=False)
+            usado = parse_usado(row.get("usado"))
+        except ValueError as e:
+            results[index] = BulkImportRowResult(row=index + 1, prefix=raw_prefix, status="error", detail=str(e))
+            continue
+
+        prefix = str(network)
+        if prefix in seen:
+            results[index] = BulkImportRowResult(row=index + 1, prefix=prefix, status="error", detail="Duplicate prefix in payload")
+            continue
+        seen.add(prefix)
+        entries.append({
+            "index": index,
+            "network": network,
+            "prefix": prefix,
+            "description": str(row.get("description") or ""),
+            "usado": usado,
+        })
+
+    # 2. Pais existentes bloqueados e resolvidos no banco, antes de verificar existência
+    lock_existing_parents(db, entries)
+
+    # 3. Prefixos que já existem no banco
+    existing = {}
+    prefixes = [entry["prefix"] for entry in entries]
+    for start in range(0, len(prefixes), IN_CHUNK_SIZE):
+        chunk = prefixes[start:start + IN_CHUNK_SIZE]
+        for prefix_id, prefix, parent_id in db.query(IPPrefix.id, IPPrefix.prefix, IPPrefix.parent_id).filter(IPPrefix.prefix.in_(chunk)):
+            existing[prefix] = (prefix_id, parent_id)
+
+    new_entries = []
+    for entry in entries:
+        if entry["prefix"] in existing:
+            prefix_id, parent_id = existing[entry["prefix"]]
+            results[entry["index"]] = BulkImportRowResult(
+                row=entry["index"] + 1, prefix=entry["prefix"], status="exists", id=prefix_id, parent_id=parent_id
+            )
+        else:
+            new_entries.append(entry)
+
+    # 4. Resolução de pais em um passe ordenado
+    resolve_parents(new_entries)
+    mark_existing_children(db, new_entries)
+
+    # 5. Inserção nível a nível (pais antes dos filhos novos)
+    insert_entries(db, new_entries, user_id)
+    adopt_existing_children(db, new_entries)
+    for entry in new_entries:
+        free_space_index.stage(db, "reserve", entry["parent_id"], int(entry["network"].network_address), entry["network"].prefixlen)
+        results[entry["index"]] = BulkImportRowResult(
+            row=entry["index"] + 1, prefix=entry["prefix"], status="created", id=entry["id"], parent_id=entry["parent_id"]
+        )
+
+    refresh_rollups(db, [entry["id"] for entry in new_entries])
+
+    return BulkImportResponse(
+        created=len(new_entries),
+        existing=sum(1 for result in results if result.status == "exists"),
+        errors=sum(1 for result in results if result.status == "error"),
+        results=results,
+    )
+
+
+def supernet_start(address: int, prefixlen: int, max_bits: int) -> int:
+    return address >> (max_bits - prefixlen) << (max_bits - prefixlen)
+
+
+def resolve_existing_parents(db: Session, entries: List[dict]):
+    """Define existing_parent_id/existing_parent_len (-1 sem pai) de cada entrada, consultando o banco.
+
+    Os pais possíveis são as super-redes da entrada (como em most_specific_parent_id),
+    só nas máscaras que existem no banco; cada super-rede compartilhada entre
+    entradas é buscada uma única vez.
+    """
+    lengths = {4: [], 6: []}
+    for is_ipv6, prefixlen in db.query(IPPrefix.is_ipv6, IPPrefix.prefixlen).filter(
+        IPPrefix.prefixlen.isnot(None)
+    ).distinct():
+        lengths[6 if is_ipv6 else 4].append(prefixlen)
+    for family_lengths in lengths.values():
+        family_lengths.sort()
+
+    def enclosing_length(version: int, prefixlen: int) -> Optional[int]:
+        """Maior máscara existente no banco menor que prefixlen"""
+        position = bisect.bisect_left(lengths[version], prefixlen)
+        return lengths[version][position - 1] if position else None
+
+    supernets = {}  # (versão, início, prefixlen) -> CIDR
+    for entry in entries:
+        network = entry["network"]
+        address = int(network.network_address)
+        prefixlen = enclosing_length(network.version, network.prefixlen)
+        while prefixlen is not None:
+            key = (network.version, supernet_start(address, prefixlen, network.max_prefixlen), prefixlen)
+            if key in supernets:
+                break  # As super-redes mais curtas também já foram vistas
+            supernets[key] = str(type(network)((key[1], prefixlen)))
+            prefixlen = enclosing_length(network.version, prefixlen)
+
+    found = {}
+    keys = {cidr: key for key, cidr in supernets.items()}
+    cidrs = list(keys)
+    for start in range(0, len(cidrs), IN_CHUNK_SIZE):
+        chunk = cidrs[start:start + IN_CHUNK_SIZE]
+        for prefix_id, prefix in db.query(IPPrefix.id, IPPrefix.prefix).filter(IPPrefix.prefix.in_(chunk)):
+            found[keys[prefix]] = prefix_id
+
+    def nearest_at(version: int, address: int, prefixlen: Optional[int]) -> tuple:
+        if prefixlen is None:
+            return None, -1
+        return nearest[(version, supernet_start(address, prefixlen, 32 if version == 4 else 128), prefixlen)]
+
+    # Pai existente mais específico de cada super-rede, da menor máscara para a maior
+    nearest = {}
+    for key in sorted(supernets, key=lambda k: k[2]):
+        version, start, prefixlen = key
+        if key in found:
+            nearest[key] = (found[key], prefixlen)
+        else:
+            nearest[key] = nearest_at(version, start, enclosing_length(version, prefixlen))
+
+    for entry in entries:
+        network = entry["network"]
+        entry["existing_parent_id"], entry["existing_parent_len"] = nearest_at(
+            network.version, int(network.network_address), enclosing_length(network.version, network.prefixlen)
+        )
+
+
+def lock_existing_parents(db: Session, entries: List[dict]):
+    """Bloqueia os pais existentes das entradas (do menos para o mais específico) e os resolve já sob o lock.
+
+    Como em write_locks.lock_parent_of: se outro escritor criou um pai mais
+    específico enquanto esperávamos, bloqueia também esse e resolve de novo.
+    """
+    locked = set()
+    while True:
+        resolve_existing_parents(db, entries)
+        missing = {
+            (entry["existing_parent_len"], entry["network"].version, entry["existing_parent_id"])
+            for entry in entries
+            if (entry["existing_parent_id"], entry["network"].version) not in locked
+        }
+        if not missing:
+            return
+        for _, version, parent_id in sorted(missing, key=lambda m: (m[0], m[1], m[2] or 0)):
+            write_locks.lock_parent(db, parent_id, version)
+            locked.add((parent_id, version))
+
+
+def resolve_parents(entries: List[dict]):
+    """Define parent_entry (pai novo) ou parent_id (pai existente) e o nível de cada entrada"""
+    entries.sort(key=lambda e: (e["network"].version, int(e["network"].network_address), e["network"].prefixlen))
+
+    stack = []
+    for entry in entries:
+        network = entry["network"]
+        while stack and not (
+            stack[-1]["network"].version == network.version and network.subnet_of(stack[-1]["network"])
+        ):
+            stack.pop()
+
+        if stack and stack[-1]["network"].prefixlen > entry["existing_parent_len"]:
+            entry["parent_entry"] = stack[-1]
+            entry["parent_id"] = None
+            entry["level"] = stack[-1]["level"] + 1
+        else:
+            entry["parent_entry"] = None
+            entry["parent_id"] = entry["existing_parent_id"]
+            entry["level"] = 0
+        stack.append(entry)
+
+
+def mark_existing_children(db: Session, entries: List[dict]):
+    """Define has_existing_children: se a entrada vai adotar prefixos do banco (chamar antes de inserir).
+
+    adopt_children só move filhos diretos do pai existente; o de uma entrada
+    com pai novo é o mesmo do pai novo. Basta então buscar os filhos diretos
+    desses pais na faixa coberta pelas entradas e procurar cada entrada com
+    busca binária nos inícios encontrados.
+    """
+    children = {}  # (versão, pai existente) -> [(início, prefixlen)]
+    for version in (4, 6):
+        family = [entry for entry in entries if entry["network"].version == version]
+        if not family:
+            continue
+        low = min(int(entry["network"].network_address) for entry in family)
+        high = max(int(entry["network"].broadcast_address) for entry in family)
+        parent_ids = list({entry["existing_parent_id"] for entry in family})
+        for start in range(0, len(parent_ids), IN_CHUNK_SIZE):
+            chunk = parent_ids[start:start + IN_CHUNK_SIZE]
+            parent_condition = IPPrefix.parent_id.in_([parent_id for parent_id in chunk if parent_id is not None])
+            if None in chunk:
+                parent_condition = or_(parent_condition, IPPrefix.parent_id.is_(None))
+            for parent_id, network_start, prefixlen in db.query(
+                IPPrefix.parent_id, IPPrefix.network_start, IPPrefix.prefixlen
+            ).filter(
+                parent_condition,
+                IPPrefix.is_ipv6 == (version == 6),
+                IPPrefix.network_start.between(low, high)
+            ):
+                children.setdefault((version, parent_id), []).append((network_start, prefixlen))
+
+    for rows in children.values():
+        rows.sort()
+    for entry in entries:
+        network = entry["network"]
+        rows = children.get((network.version, entry["existing_parent_id"]), [])
+        low = bisect.bisect_left(rows, (int(network.network_address), -1))
+        high = bisect.bisect_right(rows, (int(network.broadcast_address), network.max_prefixlen + 1))
+        # Só os que começam no mesmo endereço podem ter máscara menor: a busca para cedo
+        entry["has_existing_children"] = any(rows[i][1] > network.prefixlen for i in range(low, high))
+
+
+def insert_entries(db: Session, entries: List[dict], user_id: int):
+    """Insere as entradas nível a nível e preenche entry["id"]"""
+    levels: Dict[int, List[dict]] = {}
+    for entry in entries:
+        levels.setdefault(entry["level"], []).append(entry)
+
+    conn = db.connection()
+    now = datetime.utcnow()
+    table = IPPrefix.__table__
+
+    for level in sorted(levels):
+        level_entries = levels[level]
+        rows = []
+        for entry in level_entries:
+            if entry["parent_entry"] is not None:
+                entry["parent_id"] = entry["parent_entry"]["id"]
+            rows.append({
+                "prefix": entry["prefix"],
+                "description": entry["description"],
+                "usado": entry["usado"],
+                "is_auto_created": False,
+                "parent_id": entry["parent_id"],
+                "is_ipv6": entry["network"].version == 6,
+                "created_at": now,
+                "updated_at": now,
+                "user_id": user_id,
+                **network_columns(entry["network"]),
+            })
+
+        if conn.dialect.name == "postgresql":
+            copy_rows(conn, rows)
+        else:
+            conn.execute(table.insert(), rows)
+
+        ids = {}
+        prefixes = [entry["prefix"] for entry in level_entries]
+        for start in range(0, len(prefixes), IN_CHUNK_SIZE):
+            chunk = prefixes[start:start + IN_CHUNK_SIZE]
+            ids.update({prefix: prefix_id for prefix_id, prefix in conn.execute(
+                select(table.c.id, table.c.prefix).where(table.c.prefix.in_(chunk))
+            )})
+        for entry in level_entries:
+            entry["id"] = ids[entry["prefix"]]
+
+
+def adopt_existing_children(db: Session, entries: List[dict]):
+    """Move para cada entrada nova os prefixos já existentes que ela contém.
+
+    Em ordem de nível (pais novos antes dos filhos novos), um UPDATE de faixa
+    por entrada que já continha prefixos do banco (mark_existing_children).
+    """
+    for entry in sorted(entries, key=lambda e: e["level"]):
+        if entry["has_existing_children"]:
+            adopt_children(db, entry["id"], entry["parent_id"], entry["network"])
+
+
+def copy_rows(conn, rows: List[dict]):
+    """Grava as linhas com COPY ... FROM STDIN (psycopg2) na mesma transação"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            "" if row[column] is None else (row[column].isoformat() if isinstance(row[column], datetime) else row[column])
+            for column in COPY_COLUMNS
+        ])
+    buffer.seek(0)
+
+    cursor = conn.connection.driver_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {IPPrefix.__tablename__} ({', '.join(COPY_COLUMNS)}) FROM STDIN "
+            "WITH (FORMAT csv, FORCE_NOT_NULL (description))",
+            buffer
+        )
+    finally:
+        cursor.close()
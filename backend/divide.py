@@ -0,0 +1,206 @@
+"""
+Divisão de um prefixo em sub-redes (POST /prefixes/{id}/divide).
+
+A existência das sub-redes é verificada com uma única consulta de faixa, as
+sub-redes são geradas sob demanda (sem montar a lista inteira) e inseridas
+em lotes com executemany. Divisões grandes rodam como job em background, com
+um commit a cada DIVIDE_COMMIT_SIZE sub-redes para não segurar o lock do pai
+e a transação de escrita durante o job inteiro; acima de MAX_DIVIDE_SUBNETS
+a divisão é recusada.
+"""
+
+import bisect
+import ipaddress
+import os
+from datetime import datetime
+from typing import Callable, Iterator, Optional
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import IPPrefix, network_columns
+from free_space import free_space_index
+from locks import write_locks
+from lookup import NO_OWNER, flatten_segments
+from reparent import adopt_children
+from rollup import refresh_rollups
+from versioned_cache import bump_data_version
+
+DIVIDE_BATCH_SIZE = 1000
+DIVIDE_SYNC_LIMIT = 4096  # Acima disso a divisão vira job em background
+DIVIDE_COMMIT_SIZE = 16384  # Sub-redes por transação nos jobs
+MAX_DIVIDE_SUBNETS = int(os.getenv("MAX_DIVIDE_SUBNETS", str(2 ** 20)))  # Ex: /8 em /28
+
+
+def subnet_range_query(db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                       target_mask: int, count: Optional[int], *columns, offset: int = 0):
+    """Prefixos /target_mask dentro das count sub-redes de network a partir da offset-ésima"""
+    size = 2 ** (network.max_prefixlen - target_mask)
+    if count is None:
+        count = 2 ** (target_mask - network.prefixlen) - offset
+    start = int(network.network_address) + offset * size
+    end = start + count * size - 1
+
+    return db.query(*(columns or (IPPrefix,))).filter(
+        IPPrefix.is_ipv6 == (network.version == 6),
+        IPPrefix.network_start >= start,
+        IPPrefix.network_start <= end,
+        IPPrefix.prefixlen == target_mask
+    ).order_by(IPPrefix.network_start)
+
+
+def subnet_parents(db: Session, prefix: IPPrefix, network: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                   target_mask: int) -> tuple:
+    """(inícios, donos) dos prefixos já existentes entre prefix e as sub-redes /target_mask.
+
+    Ex: ao dividir um /16 em /19 com um /17 já cadastrado, as sub-redes dentro
+    do /17 ficam sob ele. Sem intermediários, tudo fica sob o próprio prefix.
+    Os intermediários também recebem filhos, então são bloqueados (do menos
+    para o mais específico).
+    """
+    containers = db.query(IPPrefix.network_start, IPPrefix.prefixlen, IPPrefix.network_end, IPPrefix.id).filter(
+        IPPrefix.is_ipv6 == (network.version == 6),
+        IPPrefix.network_start >= int(network.network_address),
+        IPPrefix.network_end <= int(network.broadcast_address),
+        IPPrefix.prefixlen > network.prefixlen,
+        IPPrefix.prefixlen < target_mask
+    ).order_by(IPPrefix.prefixlen, IPPrefix.id).all()
+    for container in containers:
+        write_locks.lock_parent(db, container.id, network.version)
+    starts, owners = flatten_segments([tuple(row) for row in containers])
+    return starts, [prefix.id if owner == NO_OWNER else owner for owner in owners]
+
+
+def iter_subnets(network: ipaddress.IPv4Network | ipaddress.IPv6Network, target_mask: int,
+                 offset: int, count: int) -> Iterator[ipaddress.IPv4Network | ipaddress.IPv6Network]:
+    """count sub-redes /target_mask de network a partir da offset-ésima, sem percorrer as anteriores"""
+    size = 2 ** (network.max_prefixlen - target_mask)
+    start = int(network.network_address) + offset * size
+    for i in range(count):
+        yield type(network)((start + i * size, target_mask))
+
+
+def subnet_parent(starts: list, owners: list, address: int, default: int) -> int:
+    position = bisect.bisect_right(starts, address) - 1
+    return owners[position] if position >= 0 else default
+
+
+def divide_prefix_subnets(db: Session, prefix: IPPrefix, target_mask: int, count: Optional[int],
+                          user_id: int, on_progress: Optional[Callable[[int], None]] = None, offset: int = 0) -> int:
+    """Cria as sub-redes que ainda não existem; retorna o total (existentes + criadas). Não faz commit.
+
+    offset/count escolhem a faixa de sub-redes (count None = até o fim de prefix).
+    """
+    network = ipaddress.ip_network(prefix.prefix)
+    write_locks.lock_parent(db, prefix.id, network.version)
+    if count is None:
+        count = 2 ** (target_mask - network.prefixlen) - offset
+
+    # Uma única consulta de faixa para as sub-redes que já existem
+    existing = {
+        start for (start,) in subnet_range_query(db, network, target_mask, count, IPPrefix.network_start, offset=offset)
+    }
+
+    container_starts, container_ids = subnet_parents(db, prefix, network, target_mask)
+
+    conn = db.connection()
+    table = IPPrefix.__table__
+    now = datetime.utcnow()
+    total = 0
+    batch = []
+
+    for i, subnet in enumerate(iter_subnets(network, target_mask, offset, count), offset):
+        total += 1
+        if int(subnet.network_address) in existing:
+            continue
+
+        batch.append({
+            "prefix": str(subnet),
+            "description": f"Sub-rede {i+1} de {prefix.prefix}",
+            "usado": False,
+            "is_auto_created": True,
+            "parent_id": subnet_parent(container_starts, container_ids, int(subnet.network_address), prefix.id),
+            "is_ipv6": network.version == 6,
+            "user_id": user_id,
+            "created_at": now,
+            "updated_at": now,
+            **network_columns(subnet),
+        })
+        if len(batch) >= DIVIDE_BATCH_SIZE:
+            conn.execute(table.insert(), batch)
+            batch = []
+            if on_progress:
+                on_progress(total)
+
+    if batch:
+        conn.execute(table.insert(), batch)
+    if on_progress:
+        on_progress(total)
+
+    # Ids das sub-redes (novas e existentes), para a adoção abaixo
+    subnet_ids = {
+        start: prefix_id for prefix_id, start in subnet_range_query(
+            db, network, target_mask, count, IPPrefix.id, IPPrefix.network_start, offset=offset
+        )
+    }
+
+    # Filhos mais específicos que já existiam passam para a sub-rede que os contém
+    size = 2 ** (network.max_prefixlen - target_mask)
+    base = int(network.network_address)
+    range_start = base + offset * size
+    parent_ids = set(container_ids) | {prefix.id}
+    nested_starts = {
+        base + (start - base) // size * size
+        for (start,) in db.query(IPPrefix.network_start).filter(
+            IPPrefix.parent_id.in_(parent_ids),
+            IPPrefix.is_ipv6 == (network.version == 6),
+            IPPrefix.network_start.between(range_start, range_start + count * size - 1),
+            IPPrefix.prefixlen > target_mask
+        )
+    }
+    adopted = []
+    for start in sorted(nested_starts & subnet_ids.keys()):
+        parent_id = subnet_parent(container_starts, container_ids, start, prefix.id)
+        if adopt_children(db, subnet_ids[start], parent_id, type(network)((start, target_mask))):
+            adopted.append(subnet_ids[start])
+
+    for parent_id in parent_ids:
+        free_space_index.stage(db, "invalidate", parent_id)
+    refresh_rollups(db, [prefix.id, *container_ids, *adopted])
+    return total
+
+
+def divide_job(prefix_id: int, target_mask: int, count: Optional[int], user_id: int):
+    """Função do job de divisão, com sessão própria e um commit a cada DIVIDE_COMMIT_SIZE sub-redes.
+
+    Entre os commits o lock do pai é liberado e outras escritas seguem; o progresso
+    do job vai no mesmo commit. Se o job falhar no meio, as sub-redes já gravadas
+    ficam e repetir a divisão completa o resto.
+    """
+    def run(job) -> dict:
+        db = SessionLocal()
+        try:
+            total = 0
+            offset = 0
+            while True:
+                prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
+                if not prefix:
+                    raise ValueError("Prefix not found")
+                subnet_count = count if count is not None else 2 ** (target_mask - prefix.prefixlen)
+                if offset >= subnet_count:
+                    break
+
+                chunk = min(DIVIDE_COMMIT_SIZE, subnet_count - offset)
+                total += divide_prefix_subnets(
+                    db, prefix, target_mask, chunk, user_id,
+                    lambda processed: job.set_progress(offset + processed), offset
+                )
+                bump_data_version(db)
+                job.save_progress(db)
+                db.commit()
+                offset += chunk
+            return {
+                "prefix_id": prefix_id,
+                "message": f"Created {total} subnets with /{target_mask} mask",
+            }
+        finally:
+            db.close()
+    return run
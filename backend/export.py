@@ -0,0 +1,115 @@
+"""
+Exportação em streaming dos prefixos (GET /export).
+
+As linhas saem de um cursor no servidor em lotes de tamanho fixo e são
+serializadas (CSV ou NDJSON) e, opcionalmente, comprimidas com gzip à medida
+que são lidas, então a memória usada não depende do tamanho da tabela. A
+utilização vem das colunas de rollup, as mesmas regras da hierarquia.
+"""
+
+import csv
+import io
+import json
+import zlib
+from typing import Iterable, Iterator, List
+from sqlalchemy import select
+from database import SessionLocal
+from models import IPPrefix
+
+EXPORT_BATCH_SIZE = 1000
+
+EXPORT_FIELDS = [
+    "id", "prefix", "description", "usado", "is_auto_created", "parent_id",
+    "is_ipv6", "user_id", "created_at", "updated_at",
+]
+UTILIZATION_FIELDS = [
+    "total_addresses", "used_addresses", "available_addresses", "utilization_percent", "status",
+]
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+}
+
+
+def export_fields(include_utilization: bool) -> List[str]:
+    return EXPORT_FIELDS + (UTILIZATION_FIELDS if include_utilization else [])
+
+
+def iter_export_rows(include_utilization: bool) -> Iterator[dict]:
+    """Linhas da exportação lidas de um cursor no servidor, em ordem de id"""
+    columns = [getattr(IPPrefix, field) for field in EXPORT_FIELDS]
+    if include_utilization:
+        columns += [IPPrefix.prefixlen, IPPrefix.used_addresses, IPPrefix.status]
+
+    db = SessionLocal()
+    try:
+        statement = select(*columns).order_by(IPPrefix.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        for row in db.execute(statement):
+            data = {field: getattr(row, field) for field in EXPORT_FIELDS}
+            for field in ("created_at", "updated_at"):
+                if data[field] is not None:
+                    data[field] = data[field].isoformat()
+
+            if include_utilization:
+                if row.prefixlen is None:
+                    total_addresses = 0
+                else:
+                    total_addresses = 2 ** ((128 if row.is_ipv6 else 32) - row.prefixlen)
+                used_addresses = row.used_addresses or 0
+                data.update({
+                    "total_addresses": total_addresses,
+                    "used_addresses": used_addresses,
+                    "available_addresses": total_addresses - used_addresses,
+                    "utilization_percent": round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0,
+                    "status": row.status.value if row.status else "livre",
+                })
+            yield data
+    finally:
+        db.close()
+
+
+def iter_csv(rows: Iterable[dict], fields: List[str]) -> Iterator[str]:
+    """CSV com cabeçalho, um bloco de texto por lote de linhas"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows: Iterable[dict]) -> Iterator[str]:
+    """Um objeto JSON por linha, um bloco de texto por lote de linhas"""
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(row, ensure_ascii=False))
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+
+def gzip_stream(chunks: Iterable[str]) -> Iterator[bytes]:
+    """Comprime os blocos com gzip à medida que são gerados"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(export_format: str, include_utilization: bool, compress: bool) -> Iterator[str | bytes]:
+    rows = iter_export_rows(include_utilization)
+    if export_format == "csv":
+        chunks = iter_csv(rows, export_fields(include_utilization))
+    else:
+        chunks = iter_ndjson(rows)
+    return gzip_stream(chunks) if compress else chunks
@@ -0,0 +1,58 @@
+"""
+Serialização JSON rápida para respostas grandes.
+
+As rotas de leitura pesadas (/hierarchy, /summary, /prefixes) montam dicts
+simples e os devolvem direto em uma FastJSONResponse, sem revalidar tudo
+contra o response_model. Com orjson instalado a codificação é feita por ele;
+o orjson não aceita inteiros acima de 64 bits (tamanhos de prefixos IPv6), e
+nesse caso as listas são codificadas item a item, de modo que só as linhas
+afetadas passam pelo json da biblioteca padrão (usado em tudo sem orjson).
+Listas longas vão em blocos, para não recodificar a lista inteira.
+"""
+
+import enum
+import json
+from datetime import date, datetime
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # Dependência opcional: sem ela usa-se o json da biblioteca padrão
+    orjson = None
+
+
+# Listas longas são codificadas em blocos deste tamanho
+CHUNK_SIZE = 1024
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, enum.Enum):
+        return value.value
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    """JSON compacto em UTF-8, no mesmo formato do JSONResponse do Starlette"""
+    if orjson is not None:
+        if isinstance(content, (list, tuple)) and len(content) > CHUNK_SIZE:
+            # Em blocos: um inteiro grande só faz recodificar o próprio bloco
+            return b"[" + b",".join(
+                dumps(content[start:start + CHUNK_SIZE])[1:-1]
+                for start in range(0, len(content), CHUNK_SIZE)
+            ) + b"]"
+        try:
+            return orjson.dumps(content)
+        except TypeError:  # orjson.JSONEncodeError, ex: inteiro de 128 bits
+            # Recodificar item a item, para que só as linhas afetadas passem pelo json
+            if isinstance(content, (list, tuple)):
+                return b"[" + b",".join(dumps(item) for item in content) + b"]"
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse que codifica com dumps (orjson quando possível), sem jsonable_encoder"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,321 @@
+"""
+Índice de espaço livre por prefixo pai (alocador buddy).
+
+O espaço livre de um pai é o que não está coberto pelos seus filhos diretos,
+decomposto em blocos CIDR alinhados máximos e guardado em listas livres
+ordenadas por tamanho de máscara. Alocar um /N pega o bloco adequado e o
+divide como um buddy allocator; liberar junta o bloco com o seu "buddy"
+enquanto ele também estiver livre. Os índices são montados sob demanda (uma
+consulta dos filhos diretos) e atualizados a cada commit.
+
+O cache vale para uma versão dos dados (data_version): um commit deste processo
+que leva a versão de N para N+1 é aplicado nos índices; se a versão no banco
+mudou por escritas de outro worker ou réplica, o cache inteiro é descartado.
+"""
+
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session
+from models import IPPrefix
+from versioned_cache import get_data_version
+
+MAX_CACHED_PARENTS = 1024
+
+
+def aligned_blocks(start: int, end: int, max_bits: int) -> Iterator[Tuple[int, int]]:
+    """Decompõe o intervalo [start, end] nos maiores blocos CIDR alinhados (início, prefixlen)"""
+    while start <= end:
+        # Maior bloco alinhado em start que cabe no intervalo
+        size = start & -start if start else 1 << max_bits
+        while size > end - start + 1:
+            size >>= 1
+        yield start, max_bits - size.bit_length() + 1
+        start += size
+
+
+def free_ranges(start: int, end: int, used: List[Tuple[int, int]]) -> Iterator[Tuple[int, int]]:
+    """Intervalos de [start, end] não cobertos por used (lista ordenada de (início, fim))"""
+    cursor = start
+    for used_start, used_end in used:
+        if used_end < cursor:
+            continue
+        if used_start > cursor:
+            yield cursor, min(used_start - 1, end)
+        cursor = max(cursor, used_end + 1)
+        if cursor > end:
+            return
+    if cursor <= end:
+        yield cursor, end
+
+
+class FreeBlocks:
+    """Listas livres (prefixlen -> inícios ordenados) do espaço de um prefixo pai"""
+
+    def __init__(self, start: int, prefixlen: int, max_bits: int, used: List[Tuple[int, int]]):
+        self.start = start
+        self.prefixlen = prefixlen
+        self.max_bits = max_bits
+        self.end = start + (1 << (max_bits - prefixlen)) - 1
+        self.used = sorted(set(used))
+        self.nested = False  # Filhos diretos sobrepostos (drift): liberar exige reconstruir
+        self._rebuild()
+
+    def _rebuild(self):
+        self.free: Dict[int, List[int]] = {}
+        for gap_start, gap_end in free_ranges(self.start, self.end, self.used):
+            for block_start, block_len in aligned_blocks(gap_start, gap_end, self.max_bits):
+                self.free.setdefault(block_len, []).append(block_start)
+        self.nested = False
+        max_end = -1
+        for used_start, used_end in self.used:
+            if used_start <= max_end:
+                self.nested = True
+            max_end = max(max_end, used_end)
+
+    def _size(self, prefixlen: int) -> int:
+        return 1 << (self.max_bits - prefixlen)
+
+    def _add_free(self, start: int, prefixlen: int):
+        bisect.insort(self.free.setdefault(prefixlen, []), start)
+
+    def _remove_free(self, start: int, prefixlen: int) -> bool:
+        blocks = self.free.get(prefixlen)
+        if not blocks:
+            return False
+        index = bisect.bisect_left(blocks, start)
+        if index < len(blocks) and blocks[index] == start:
+            blocks.pop(index)
+            return True
+        return False
+
+    def _split(self, block_start: int, block_len: int, target_start: int, target_len: int):
+        """Divide o bloco livre até target, devolvendo os buddies que sobram às listas"""
+        while block_len < target_len:
+            block_len += 1
+            half = self._size(block_len)
+            if target_start >= block_start + half:
+                self._add_free(block_start, block_len)
+                block_start += half
+            else:
+                self._add_free(block_start + half, block_len)
+
+    def find(self, prefixlen: int, strategy: str = "first") -> Optional[Tuple[int, int]]:
+        """Bloco livre (início, prefixlen) onde cabe um /prefixlen, sem alterar o índice"""
+        candidates = [(blocks[0], length) for length, blocks in self.free.items() if blocks and length <= prefixlen]
+        if not candidates:
+            return None
+        if strategy == "best":
+            # Menor bloco que comporta a alocação (maior prefixlen), menor endereço
+            return max(candidates, key=lambda c: (c[1], -c[0]))
+        return min(candidates)
+
+    def allocate(self, prefixlen: int, strategy: str = "first") -> Optional[int]:
+        """Reserva um /prefixlen e retorna o seu início (None se não houver espaço)"""
+        block = self.find(prefixlen, strategy)
+        if block is None:
+            return None
+        block_start, block_len = block
+        self._remove_free(block_start, block_len)
+        self._split(block_start, block_len, block_start, prefixlen)
+        bisect.insort(self.used, (block_start, block_start + self._size(prefixlen) - 1))
+        return block_start
+
+    def reserve(self, start: int, prefixlen: int):
+        """Marca um novo filho direto como ocupado"""
+        used = (start, start + self._size(prefixlen) - 1)
+        index = bisect.bisect_left(self.used, used)
+        if index < len(self.used) and self.used[index] == used:
+            return
+        self.used.insert(index, used)
+
+        # Bloco livre que contém o novo filho
+        for block_len in range(prefixlen, self.prefixlen - 1, -1):
+            block_start = start & ~(self._size(block_len) - 1)
+            if self._remove_free(block_start, block_len):
+                self._split(block_start, block_len, start, prefixlen)
+                return
+
+        # O filho cobre espaço já ocupado (sobreposição): retirar os blocos livres contidos nele
+        self.nested = True
+        for block_len, blocks in self.free.items():
+            if block_len > prefixlen:
+                low = bisect.bisect_left(blocks, used[0])
+                high = bisect.bisect_right(blocks, used[1])
+                del blocks[low:high]
+
+    def release(self, start: int, prefixlen: int):
+        """Devolve o espaço de um filho direto removido, juntando buddies livres"""
+        used = (start, start + self._size(prefixlen) - 1)
+        index = bisect.bisect_left(self.used, used)
+        if index >= len(self.used) or self.used[index] != used:
+            return
+        self.used.pop(index)
+
+        if self.nested:
+            self._rebuild()
+            return
+
+        while prefixlen > self.prefixlen:
+            buddy = start ^ self._size(prefixlen)
+            if not self._remove_free(buddy, prefixlen):
+                break
+            start = min(start, buddy)
+            prefixlen -= 1
+        self._add_free(start, prefixlen)
+
+
+class FreeSpaceIndex:
+    """Cache LRU de FreeBlocks por parent_id, sincronizado com os commits"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._parents: "OrderedDict[int, FreeBlocks]" = OrderedDict()
+        self._version: Optional[int] = None
+        self._watched = set()
+
+    def get(self, db: Session, parent: IPPrefix) -> FreeBlocks:
+        """FreeBlocks do pai, montado a partir dos filhos diretos se ainda não estiver em cache"""
+        with self._lock:
+            version = get_data_version(db)
+            if version != self._version:
+                # Escritas de outro processo: nenhum índice em cache é confiável
+                self._parents.clear()
+                self._version = version
+
+            blocks = self._parents.get(parent.id)
+            if blocks is not None:
+                self._parents.move_to_end(parent.id)
+                return blocks
+
+            max_bits = 128 if parent.is_ipv6 else 32
+            used = [
+                (start, start + (1 << (max_bits - prefixlen)) - 1)
+                for start, prefixlen in db.query(IPPrefix.network_start, IPPrefix.prefixlen).filter(
+                    IPPrefix.parent_id == parent.id, IPPrefix.prefixlen.isnot(None)
+                )
+            ]
+            blocks = FreeBlocks(parent.network_start, parent.prefixlen, max_bits, used)
+            self._parents[parent.id] = blocks
+            while len(self._parents) > MAX_CACHED_PARENTS:
+                self._parents.popitem(last=False)
+            return blocks
+
+    def allocate(self, db: Session, parent: IPPrefix, prefixlen: int, count: int, strategy: str = "first") -> Optional[List[int]]:
+        """Reserva count blocos /prefixlen no pai; None (e nada reservado) se não houver espaço.
+
+        Cada bloco escolhido é conferido com uma consulta de faixa indexada: prefixos
+        que o sobrepõem sem serem filhos diretos (ex: órfãos) são marcados como
+        ocupados no índice e a busca continua.
+        """
+        max_bits = 128 if parent.is_ipv6 else 32
+        size = 1 << (max_bits - prefixlen)
+
+        with self._lock:
+            blocks = self.get(db, parent)
+            starts = []
+            while len(starts) < count:
+                start = blocks.allocate(prefixlen, strategy)
+                if start is None:
+                    # Desfazer as reservas parciais
+                    self.invalidate(parent.id)
+                    return None
+
+                conflicts = db.query(IPPrefix.network_start, IPPrefix.prefixlen).filter(
+                    IPPrefix.is_ipv6 == parent.is_ipv6,
+                    IPPrefix.network_start <= start + size - 1,
+                    IPPrefix.network_end >= start,
+                    IPPrefix.prefixlen > parent.prefixlen
+                ).all()
+                if conflicts:
+                    blocks.release(start, prefixlen)
+                    for conflict_start, conflict_len in conflicts:
+                        blocks.reserve(conflict_start, conflict_len)
+                    continue
+                starts.append(start)
+            return starts
+
+    def invalidate(self, parent_id: Optional[int]):
+        with self._lock:
+            self._parents.pop(parent_id, None)
+
+    @staticmethod
+    def stage(session: Session, action: str, parent_id: Optional[int], start: int = 0, prefixlen: int = 0):
+        """Agenda uma alteração nas listas livres de parent_id para o próximo commit.
+
+        "reserve"/"release" marcam o bloco start/prefixlen como ocupado/livre;
+        "invalidate" descarta o índice do pai, para quando o conjunto de filhos
+        muda de um jeito que não vale a pena replicar (ex: UPDATE de parent_id
+        em massa ou sub-redes de uma divisão).
+        """
+        if parent_id is not None:
+            session.info.setdefault("free_space_pending", []).append((action, parent_id, start, prefixlen))
+
+    def _apply(self, action: str, parent_id: int, start: int, prefixlen: int):
+        blocks = self._parents.get(parent_id)
+        if blocks is None:
+            return
+        if action == "reserve":
+            blocks.reserve(start, prefixlen)
+        elif action == "release":
+            blocks.release(start, prefixlen)
+        else:
+            del self._parents[parent_id]
+
+    def _commit(self, changes: list, version: Optional[int], bumps: int):
+        """Aplica as alterações de uma transação; version é a data_version que ela gravou (None se não mudou)"""
+        with self._lock:
+            if version is not None:
+                if self._version != version - bumps:
+                    # Outro processo escreveu entre a versão em cache e este commit
+                    self._parents.clear()
+                    self._version = None
+                    return
+                self._version = version
+            for change in changes:
+                self._apply(*change)
+
+    def watch(self, session_factory):
+        """Mantém os índices em cache em sincronia com os commits das sessões do factory"""
+        if id(session_factory) in self._watched:
+            return
+        self._watched.add(id(session_factory))
+
+        @event.listens_for(session_factory, "after_flush")
+        def collect_changes(session, flush_context):
+            for obj in session.new:
+                if isinstance(obj, IPPrefix) and obj.prefixlen is not None:
+                    self.stage(session, "reserve", obj.parent_id, obj.network_start, obj.prefixlen)
+            for obj in session.deleted:
+                if isinstance(obj, IPPrefix):
+                    self.stage(session, "invalidate", obj.id)
+                    if obj.prefixlen is not None:
+                        self.stage(session, "release", obj.parent_id, obj.network_start, obj.prefixlen)
+            for obj in session.dirty:
+                if not isinstance(obj, IPPrefix) or obj.prefixlen is None:
+                    continue
+                history = sa_inspect(obj).attrs.parent_id.history
+                if not history.has_changes():
+                    continue
+                for old_parent_id in history.deleted:
+                    self.stage(session, "release", old_parent_id, obj.network_start, obj.prefixlen)
+                for new_parent_id in history.added:
+                    self.stage(session, "reserve", new_parent_id, obj.network_start, obj.prefixlen)
+
+        @event.listens_for(session_factory, "after_commit")
+        def apply_changes(session):
+            self._commit(
+                session.info.pop("free_space_pending", []),
+                session.info.pop("data_version", None),
+                session.info.pop("data_version_bumps", 0)
+            )
+
+        @event.listens_for(session_factory, "after_rollback")
+        def drop_changes(session):
+            for key in ("free_space_pending", "data_version", "data_version_bumps"):
+                session.info.pop(key, None)
+
+
+free_space_index = FreeSpaceIndex()
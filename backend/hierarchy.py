@@ -0,0 +1,473 @@
+"""
+Motor de hierarquia de prefixos com sub-redes calculadas.
+
+Cada prefixo é parseado uma única vez, o mapa parent_id -> filhos é montado
+uma única vez e os endereços usados são calculados de baixo para cima
+(pós-ordem) e memorizados, evitando as varreduras repetidas de toda a lista.
+
+No modo "binary" o espaço sob um prefixo real é dividido bit a bit em metades
+calculadas; no modo "compact" ele aparece como o conjunto mínimo de blocos
+CIDR livres entre os filhos reais, limitado a max_free_blocks por pai.
+"""
+
+import bisect
+import heapq
+import ipaddress
+import os
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+from free_space import aligned_blocks, free_ranges
+from models import IPPrefix
+
+MAX_FREE_BLOCKS = int(os.getenv("HIERARCHY_MAX_FREE_BLOCKS", "256"))  # Blocos livres por pai no modo compact
+
+
+def calculate_status_from_children(prefix: IPPrefix, children_status: List[str]) -> str:
+    """Calcula o status baseado no status dos filhos (incluindo sub-redes calculadas)"""
+    # Se está marcado como usado, retorna "usado"
+    if prefix.usado:
+        return "usado"
+
+    # Se não tem filhos, está livre
+    if not children_status:
+        return "livre"
+
+    # Se TODOS os filhos estão usados, pai fica usado
+    if all(status == "usado" for status in children_status):
+        return "usado"
+
+    # Se algum filho está usado ou parcialmente usado, pai fica parcialmente usado
+    if any(status in ["usado", "parcialmente_usado"] for status in children_status):
+        return "parcialmente_usado"
+
+    return "livre"
+
+
+def status_from_usage(used_addresses: int, total_addresses: int) -> str:
+    """Status de uma sub-rede calculada a partir dos endereços usados"""
+    if used_addresses == 0:
+        return "livre"
+    if used_addresses == total_addresses:
+        return "usado"
+    return "parcialmente_usado"
+
+
+def utilization(used_addresses: int, total_addresses: int) -> float:
+    return round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0.0
+
+
+def subnet_node(prefix: str, description: str, status: str, usado: bool, is_real: bool,
+                id: Optional[int], parent_id: Optional[int], total_addresses: int, used_addresses: int,
+                children: List[dict], children_count: int = 0) -> dict:
+    """Nó da hierarquia como dict simples, com os campos (e a ordem) de SubnetResponse.
+
+    Serializado direto em JSON, sem instanciar nem revalidar modelos Pydantic.
+    """
+    return {
+        "prefix": prefix,
+        "description": description,
+        "status": status,
+        "usado": usado,
+        "is_real": is_real,
+        "id": id,
+        "parent_id": parent_id,
+        "children": children,
+        "children_count": children_count,
+        "total_addresses": total_addresses,
+        "used_addresses": used_addresses,
+        "available_addresses": total_addresses - used_addresses,
+        "utilization_percent": utilization(used_addresses, total_addresses),
+    }
+
+
+def free_blocks_between(network: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                        children: List[ipaddress.IPv4Network | ipaddress.IPv6Network]) -> list:
+    """Blocos CIDR livres mínimos (início, prefixlen) entre os filhos, em ordem de endereço.
+
+    Varredura dos filhos ordenados e cada lacuna decomposta nos maiores blocos
+    alinhados, como ipaddress.collapse_addresses faria com os /max livres.
+    """
+    if not children:
+        return []
+    used = sorted((int(child.network_address), int(child.broadcast_address)) for child in children)
+    return [
+        block
+        for gap_start, gap_end in free_ranges(int(network.network_address), int(network.broadcast_address), used)
+        for block in aligned_blocks(gap_start, gap_end, network.max_prefixlen)
+    ]
+
+
+class UsedIntervalIndex:
+    """Intervalos dos prefixos 'usado' ordenados por início, com somas prefixadas.
+
+    Um prefixo usado P conta para a sub-rede S quando está contido nela e não
+    há outro prefixo real entre os dois, ou seja, quando o contêiner real mais
+    próximo de P (tamanho de máscara L) contém S: L <= S.prefixlen <= P.prefixlen.
+    Para cada tamanho de máscara consultado mantém-se um array ordenado dos
+    prefixos elegíveis; a consulta é um bisect e uma diferença de somas.
+    """
+
+    def __init__(self, all_networks, usado_networks):
+        # Tamanho da máscara do contêiner real mais próximo de cada prefixo usado
+        container_len = {}
+        by_family = {4: [], 6: []}
+        for network in all_networks:
+            by_family[network.version].append(network)
+
+        for networks in by_family.values():
+            networks.sort(key=lambda n: (int(n.network_address), n.prefixlen))
+            open_networks = []
+            for network in networks:
+                start = int(network.network_address)
+                while open_networks and int(open_networks[-1].broadcast_address) < start:
+                    open_networks.pop()
+                container_len[network] = open_networks[-1].prefixlen if open_networks else -1
+                open_networks.append(network)
+
+        self.intervals = {4: [], 6: []}
+        for network in usado_networks:
+            self.intervals[network.version].append((
+                int(network.network_address),
+                network.prefixlen,
+                container_len[network],
+                int(network.num_addresses)
+            ))
+        for intervals in self.intervals.values():
+            intervals.sort()
+
+        self._levels = {}
+
+    def _level(self, version: int, prefixlen: int):
+        key = (version, prefixlen)
+        if key not in self._levels:
+            starts = []
+            sums = [0]
+            for start, length, container, size in self.intervals[version]:
+                if container <= prefixlen <= length:
+                    starts.append(start)
+                    sums.append(sums[-1] + size)
+            self._levels[key] = (starts, sums)
+        return self._levels[key]
+
+    def used_addresses(self, subnet: ipaddress.IPv4Network | ipaddress.IPv6Network) -> int:
+        if not self.intervals[subnet.version]:
+            return 0
+        starts, sums = self._level(subnet.version, subnet.prefixlen)
+        first = bisect.bisect_left(starts, int(subnet.network_address))
+        last = bisect.bisect_right(starts, int(subnet.broadcast_address))
+        return sums[last] - sums[first]
+
+
+class HierarchyBuilder:
+    """Constrói a árvore de nós (dicts no formato de SubnetResponse) a partir da lista completa de prefixos.
+
+    Com rollups=True os agregados dos prefixos reais vêm das colunas de rollup e
+    basta carregar os níveis exibidos; collapsed_counts traz o children_count dos
+    nós no limite de depth, cujos filhos não foram carregados.
+    """
+
+    def __init__(self, prefixes: List[IPPrefix], mode: str = "binary", max_free_blocks: int = MAX_FREE_BLOCKS,
+                 rollups: bool = False, collapsed_counts: Optional[Dict[int, int]] = None):
+        self.prefixes = prefixes
+        self.rollups = rollups
+        self.collapsed_counts = collapsed_counts or {}
+        self.mode = mode
+        self.max_free_blocks = max_free_blocks
+        self._free_blocks: Dict[int, tuple] = {}
+        self.networks: Dict[int, ipaddress.IPv4Network | ipaddress.IPv6Network] = {}
+        self.children: Dict[Optional[int], List[IPPrefix]] = defaultdict(list)
+        self.used: Dict[int, int] = {}
+
+        for prefix in prefixes:
+            try:
+                self.networks[prefix.id] = ipaddress.ip_network(prefix.prefix)
+            except ValueError:
+                continue
+            self.children[prefix.parent_id].append(prefix)
+
+        # Chaves (início, tamanho da máscara) ordenadas por família, para
+        # responder "existe algum prefixo contido nesta rede?" com bisect
+        self.range_keys = {4: [], 6: []}
+        for network in self.networks.values():
+            self.range_keys[network.version].append((int(network.network_address), network.prefixlen))
+        for keys in self.range_keys.values():
+            keys.sort()
+
+        self.usage = UsedIntervalIndex(self.networks.values(), [
+            self.networks[p.id] for p in prefixes if p.usado and p.id in self.networks
+        ])
+
+        self.status: Dict[int, str] = {}
+        self.children_count: Dict[int, int] = {}
+        if rollups:
+            for prefix in prefixes:
+                self.used[prefix.id] = prefix.used_addresses or 0
+                self.status[prefix.id] = prefix.status.value if prefix.status else "livre"
+        else:
+            self._compute_rollups()
+
+    def _compute_rollups(self):
+        """Endereços usados, status e nº de filhos de cada prefixo real, em um único passe pós-ordem"""
+        top_prefixes = [
+            p for p in self.prefixes
+            if p.id in self.networks and p.parent_id not in self.networks
+        ]
+        for top in top_prefixes:
+            stack = [(top, False)]
+            while stack:
+                prefix, visited = stack.pop()
+                if not visited:
+                    stack.append((prefix, True))
+                    stack.extend((child, False) for child in self.children[prefix.id])
+                    continue
+
+                used = 0
+                children_status = []
+                for child in self.children[prefix.id]:
+                    if child.usado:
+                        # Se o filho está marcado como usado, conta todos os seus endereços
+                        used += int(self.networks[child.id].num_addresses)
+                    else:
+                        # Senão conta apenas o que ele tem de usado recursivamente
+                        used += self.used[child.id]
+                    children_status.append(self.status[child.id])
+
+                halves = self.calculated_halves(prefix)
+                for _, subnet in halves:
+                    total = int(subnet.num_addresses)
+                    children_status.append(status_from_usage(self.used_addresses_in_subnet(subnet), total))
+
+                self.used[prefix.id] = used
+                self.status[prefix.id] = calculate_status_from_children(prefix, children_status)
+                self.children_count[prefix.id] = len(self.children[prefix.id]) + len(halves)
+
+    def calculated_halves(self, prefix: IPPrefix) -> list:
+        """Metades (índice, sub-rede) calculadas sob um prefixo real, se houver relacionamento"""
+        network = self.networks[prefix.id]
+        real_children = self.children[prefix.id]
+
+        # Só gerar sub-redes calculadas se houver filhos diretos ou prefixos contidos
+        if not real_children and not self.has_contained_prefix(network):
+            return []
+        # Máxima granularidade: sempre dividir em incrementos de 1 bit
+        if network.prefixlen >= network.max_prefixlen:
+            return []
+
+        # Pular metades que já existem como prefixo real
+        real_children_prefixes = {child.prefix for child in real_children}
+        return [
+            (i, subnet)
+            for i, subnet in enumerate(network.subnets(new_prefix=network.prefixlen + 1))
+            if str(subnet) not in real_children_prefixes
+        ]
+
+    def free_blocks(self, prefix: IPPrefix) -> tuple:
+        """(blocos livres exibidos, total de blocos) entre os filhos reais diretos (modo compact).
+
+        Acima de max_free_blocks ficam os maiores blocos; o total vai em children_count.
+        """
+        if prefix.id not in self._free_blocks:
+            network = self.networks[prefix.id]
+            blocks = free_blocks_between(network, [
+                self.networks[child.id] for child in self.children[prefix.id] if child.id in self.networks
+            ])
+            total = len(blocks)
+            if total > self.max_free_blocks:
+                blocks = sorted(heapq.nsmallest(self.max_free_blocks, blocks, key=lambda block: (block[1], block[0])))
+            self._free_blocks[prefix.id] = ([type(network)(block) for block in blocks], total)
+        return self._free_blocks[prefix.id]
+
+    def has_contained_prefix(self, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> bool:
+        """Indica se existe algum prefixo real contido estritamente na rede"""
+        keys = self.range_keys[network.version]
+        position = bisect.bisect_left(keys, (int(network.network_address), network.prefixlen + 1))
+        return position < len(keys) and keys[position][0] <= int(network.broadcast_address)
+
+    def used_addresses_in_subnet(self, subnet: ipaddress.IPv4Network | ipaddress.IPv6Network) -> int:
+        """Endereços usados dentro de uma sub-rede calculada pelos filhos diretos marcados como 'usado'"""
+        return self.usage.used_addresses(subnet)
+
+    def build(self, depth: Optional[int] = None) -> List[dict]:
+        """Árvore a partir dos prefixos root (sem pai), ordenados por endereço.
+
+        depth limita quantos níveis de filhos são incluídos (None = todos);
+        nós recolhidos trazem apenas os agregados e children_count.
+        """
+        return list(self.iter_roots(depth))
+
+    def iter_roots(self, depth: Optional[int] = None) -> Iterator[dict]:
+        """Gera as árvores root uma a uma (para respostas em streaming)"""
+        roots = sorted(
+            (p for p in self.children[None] if p.id in self.networks),
+            key=lambda p: (self.networks[p.id].version, self.networks[p.id].network_address)
+        )
+        for root in roots:
+            yield self.build_subnet_tree(root, depth)
+
+        # Prefixos com texto inválido não entram na árvore; exibi-los como erro
+        for prefix in self.prefixes:
+            if prefix.id not in self.networks and prefix.parent_id is None:
+                yield self.error_node(prefix)
+
+    def error_node(self, prefix: IPPrefix) -> dict:
+        return subnet_node(
+            prefix=prefix.prefix,
+            description=prefix.description,
+            status="erro",
+            usado=prefix.usado,
+            is_real=True,
+            id=prefix.id,
+            parent_id=prefix.parent_id,
+            total_addresses=0,
+            used_addresses=0,
+            children=[]
+        )
+
+    def build_subnet_tree(self, prefix: IPPrefix, depth: Optional[int] = None) -> dict:
+        """Constrói árvore de sub-redes para um prefixo real"""
+        network = self.networks[prefix.id]
+        total_addresses = int(network.num_addresses)
+        used_addresses = self.used[prefix.id]
+
+        if prefix.id in self.collapsed_counts:
+            children_count = self.collapsed_counts[prefix.id]
+        elif self.mode == "compact":
+            children_count = len(self.children[prefix.id]) + self.free_blocks(prefix)[1]
+        elif self.rollups:
+            children_count = len(self.children[prefix.id]) + len(self.calculated_halves(prefix))
+        else:
+            children_count = self.children_count[prefix.id]
+
+        return subnet_node(
+            prefix=prefix.prefix,
+            description=prefix.description,
+            status=self.status[prefix.id],
+            usado=prefix.usado,
+            is_real=True,
+            id=prefix.id,
+            parent_id=prefix.parent_id,
+            total_addresses=total_addresses,
+            used_addresses=used_addresses,
+            children=self.generate_automatic_subnets(prefix, depth) if depth != 0 else [],
+            children_count=children_count
+        )
+
+    def calculated_subnet(self, subnet: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                          index: int, parent_network, parent_id: int,
+                          depth: Optional[int] = None) -> dict:
+        """Constrói uma sub-rede calculada e, se parcialmente usada, suas metades"""
+        used_addresses = self.used_addresses_in_subnet(subnet)
+        total_addresses = int(subnet.num_addresses)
+        status = status_from_usage(used_addresses, total_addresses)
+
+        max_prefix = 30 if subnet.version == 4 else 126
+        splittable = status == "parcialmente_usado" and subnet.prefixlen < max_prefix
+
+        return subnet_node(
+            prefix=str(subnet),
+            description=f"Sub-rede {index + 1} de {parent_network}",
+            status=status,
+            usado=False,  # Sub-redes calculadas não são marcadas como usadas
+            is_real=False,
+            id=None,
+            parent_id=parent_id,
+            total_addresses=total_addresses,
+            used_addresses=used_addresses,
+            children=self.generate_automatic_subnets_calculated(subnet, parent_id, depth) if splittable and depth != 0 else [],
+            children_count=2 if splittable else 0
+        )
+
+    def expand_calculated(self, subnet: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                          parent_id: int, depth: Optional[int] = None) -> dict:
+        """Sub-rede calculada isolada (expansão sob demanda), dentro do prefixo real parent_id"""
+        if self.mode == "compact":
+            return self.free_block_node(subnet, self.networks[parent_id], parent_id)
+        index = (int(subnet.network_address) >> (subnet.max_prefixlen - subnet.prefixlen)) & 1
+        return self.calculated_subnet(subnet, index, subnet.supernet(), parent_id, depth)
+
+    def generate_automatic_subnets(self, parent_prefix: IPPrefix, depth: Optional[int] = None) -> List[dict]:
+        """Gera filhos reais e sub-redes automáticas apenas se existir relacionamento pai/filho"""
+        parent_network = self.networks[parent_prefix.id]
+        child_depth = None if depth is None else depth - 1
+
+        real_children = sorted(
+            self.children[parent_prefix.id],
+            key=lambda p: self.networks[p.id].network_address
+        )
+        children = [
+            (self.networks[child.id].network_address, self.build_subnet_tree(child, child_depth))
+            for child in real_children
+        ]
+        if self.mode == "compact":
+            for subnet in self.free_blocks(parent_prefix)[0]:
+                children.append((subnet.network_address, self.free_block_node(subnet, parent_network, parent_prefix.id)))
+            children.sort(key=lambda item: item[0])
+            return [child for _, child in children]
+
+        for i, subnet in self.calculated_halves(parent_prefix):
+            child_subnet = self.calculated_subnet(subnet, i, parent_network, parent_prefix.id, child_depth)
+            children.append((subnet.network_address, child_subnet))
+
+        # Ordenar todos os children por endereço IP (ordenação estável: reais primeiro)
+        children.sort(key=lambda item: item[0])
+        return [child for _, child in children]
+
+    def free_block_node(self, subnet: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                        parent_network, parent_id: int) -> dict:
+        """Bloco livre do modo compact: folha calculada, sem metades"""
+        used_addresses = self.used_addresses_in_subnet(subnet)
+        total_addresses = int(subnet.num_addresses)
+        return subnet_node(
+            prefix=str(subnet),
+            description=f"Espaço livre em {parent_network}",
+            status=status_from_usage(used_addresses, total_addresses),
+            usado=False,
+            is_real=False,
+            id=None,
+            parent_id=parent_id,
+            total_addresses=total_addresses,
+            used_addresses=used_addresses,
+            children=[],
+            children_count=0
+        )
+
+    def generate_automatic_subnets_calculated(self, network: ipaddress.IPv4Network | ipaddress.IPv6Network,
+                                              parent_id: int, depth: Optional[int] = None) -> List[dict]:
+        """Gera sub-redes para redes calculadas (não reais)"""
+        child_depth = None if depth is None else depth - 1
+        return [
+            self.calculated_subnet(subnet, i, network, parent_id, child_depth)
+            for i, subnet in enumerate(network.subnets(new_prefix=network.prefixlen + 1))
+        ]
+
+
+def build_subnet_hierarchy(prefixes: List[IPPrefix], depth: Optional[int] = None,
+                           mode: str = "binary", max_free_blocks: int = MAX_FREE_BLOCKS) -> List[dict]:
+    """Constrói hierarquia com sub-redes automáticas (depth=None para a árvore completa)"""
+    return HierarchyBuilder(prefixes, mode, max_free_blocks).build(depth)
+
+
+def collapsed_children_count(network: ipaddress.IPv4Network | ipaddress.IPv6Network, child_count: int,
+                             children: list, mode: str = "binary") -> int:
+    """children_count de um nó recolhido: child_count filhos diretos mais metades ou blocos livres.
+
+    children (objetos com .prefix) precisa trazer todos os filhos no modo compact;
+    no modo binary bastam os que são metades do prefixo.
+    """
+    if not child_count:
+        return 0
+    if mode == "compact":
+        children_networks = []
+        for child in children:
+            try:
+                children_networks.append(ipaddress.ip_network(child.prefix))
+            except ValueError:
+                continue
+        return child_count + len(free_blocks_between(network, children_networks))
+    if network.prefixlen >= network.max_prefixlen:
+        return child_count
+    real_children_prefixes = {child.prefix for child in children}
+    return child_count + sum(
+        1 for half in network.subnets(new_prefix=network.prefixlen + 1)
+        if str(half) not in real_children_prefixes
+    )
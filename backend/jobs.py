@@ -0,0 +1,148 @@
+"""
+Jobs em background para operações longas (ex: dividir um /8 em /24).
+
+Os jobs rodam em um executor de uma thread por processo, um por vez. O estado
+fica na tabela jobs, então GET /jobs/{id} responde em qualquer worker e depois
+de um restart; o progresso é gravado na mesma transação do trabalho (ex: a
+cada lote da divisão), então processed nunca passa do que já foi commitado.
+Jobs interrompidos por um restart não são retomados: ao subir, o processo
+marca como failed os jobs inacabados de processos do mesmo host que não
+existem mais.
+"""
+
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Optional
+from sqlalchemy.orm import Session
+from database import SessionLocal
+from models import BackgroundJob
+from schemas import JobResponse
+
+MAX_FINISHED_JOBS = 100
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def job_response(job: BackgroundJob) -> JobResponse:
+    return JobResponse(
+        id=job.id,
+        kind=job.kind,
+        status=job.status,
+        processed=job.processed,
+        total=job.total,
+        result=job.result,
+        error=job.error,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+    )
+
+
+class Job:
+    """Job em execução, repassado à função do job para reportar progresso"""
+
+    def __init__(self, job_id: str, total: Optional[int] = None):
+        self.id = job_id
+        self.processed = 0
+        self.total = total
+
+    def set_progress(self, processed: int, total: Optional[int] = None):
+        self.processed = processed
+        if total is not None:
+            self.total = total
+
+    def save_progress(self, db: Session):
+        """Grava o progresso na transação de db (commitado junto com o trabalho)"""
+        db.query(BackgroundJob).filter(BackgroundJob.id == self.id).update(
+            {"processed": self.processed, "total": self.total}, synchronize_session=False
+        )
+
+
+class JobRunner:
+    """Executa jobs em sequência e mantém o estado deles na tabela jobs"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ipam-job")
+
+    def submit(self, kind: str, func: Callable[[Job], dict], total: Optional[int] = None) -> JobResponse:
+        """Registra e enfileira func(job); o dict retornado vira o result do job"""
+        db = SessionLocal()
+        try:
+            job = BackgroundJob(
+                id=uuid.uuid4().hex, kind=kind, status="queued", processed=0, total=total,
+                worker=worker_id(), created_at=datetime.utcnow()
+            )
+            db.add(job)
+            self._prune(db)
+            db.commit()
+            response = job_response(job)
+        finally:
+            db.close()
+        self._executor.submit(self._run, Job(response.id, total), func)
+        return response
+
+    def get(self, db: Session, job_id: str) -> Optional[BackgroundJob]:
+        return db.query(BackgroundJob).filter(BackgroundJob.id == job_id).first()
+
+    def recover(self) -> int:
+        """Marca como failed os jobs inacabados de processos deste host que não existem mais"""
+        host = f"{socket.gethostname()}:"
+        db = SessionLocal()
+        try:
+            interrupted = 0
+            for job in db.query(BackgroundJob).filter(
+                BackgroundJob.status.in_(("queued", "running")), BackgroundJob.worker.like(f"{host}%")
+            ).all():
+                pid = job.worker[len(host):]
+                if pid.isdigit() and (int(pid) == os.getpid() or not process_exists(int(pid))):
+                    job.status = "failed"
+                    job.error = "Interrupted by a worker restart"
+                    job.finished_at = datetime.utcnow()
+                    interrupted += 1
+            db.commit()
+            return interrupted
+        finally:
+            db.close()
+
+    def _run(self, job: Job, func: Callable[[Job], dict]):
+        self._update(job.id, status="running")
+        try:
+            result = func(job)
+        except Exception as e:
+            self._update(job.id, status="failed", error=str(e), finished_at=datetime.utcnow())
+        else:
+            self._update(job.id, status="done", result=result, processed=job.processed,
+                         total=job.total, finished_at=datetime.utcnow())
+
+    def _update(self, job_id: str, **values):
+        db = SessionLocal()
+        try:
+            db.query(BackgroundJob).filter(BackgroundJob.id == job_id).update(values, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def _prune(self, db: Session):
+        """Mantém apenas os MAX_FINISHED_JOBS jobs finalizados mais recentes"""
+        old_ids = [row.id for row in db.query(BackgroundJob.id).filter(
+            BackgroundJob.finished_at.isnot(None)
+        ).order_by(BackgroundJob.finished_at.desc()).offset(MAX_FINISHED_JOBS)]
+        if old_ids:
+            db.query(BackgroundJob).filter(BackgroundJob.id.in_(old_ids)).delete(synchronize_session=False)
+
+
+def process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+job_runner = JobRunner()
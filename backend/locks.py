@@ -0,0 +1,93 @@
+"""
+Locks de escrita por prefixo pai.
+
+Toda escrita que cria ou remove filhos de um prefixo pega antes o lock desse
+pai e só então resolve o pai/verifica existência no banco, eliminando as
+corridas "verifica e insere" entre escritores paralelos.
+
+PostgreSQL: pg_advisory_xact_lock por parent_id (liberado no commit/rollback,
+válido entre processos e workers). Demais bancos (SQLite): um lock único do
+processo, liberado ao fim da transação; o SQLite só admite um escritor por
+vez de qualquer forma.
+"""
+
+import ipaddress
+import threading
+from typing import Optional
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from models import IPPrefix
+
+LOCK_NAMESPACE = 0x1BA4  # Primeiro inteiro das chaves consultivas do IPAM
+ROOT_LOCK_KEYS = {4: -4, 6: -6}  # Prefixos sem pai, por família
+
+
+class WriteLocks:
+    def __init__(self):
+        # Lock simples (não reentrante): a posse é da sessão (db.info), não da
+        # thread, já que a transação pode terminar em outra thread do threadpool
+        self._process_lock = threading.Lock()
+        self._watched = set()
+
+    def lock_parent(self, db: Session, parent_id: Optional[int], version: int):
+        """Bloqueia as escritas sob parent_id (ou na raiz da família) até o fim da transação"""
+        if db.get_bind().dialect.name == "postgresql":
+            key = parent_id if parent_id is not None else ROOT_LOCK_KEYS[version]
+            db.execute(
+                text("SELECT pg_advisory_xact_lock(:namespace, :key)"),
+                {"namespace": LOCK_NAMESPACE, "key": key}
+            )
+            return
+        self._acquire_process_lock(db)
+
+    def lock_rollups(self, db: Session):
+        """Serializa o recálculo de rollups nos bancos sem locks de linha (no PostgreSQL usa-se FOR UPDATE)"""
+        if db.get_bind().dialect.name != "postgresql":
+            self._acquire_process_lock(db)
+
+    def _acquire_process_lock(self, db: Session):
+        if not db.info.get("process_write_lock"):
+            self._process_lock.acquire()
+            db.info["process_write_lock"] = True
+
+    def lock_parent_of(self, db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> Optional[int]:
+        """Bloqueia o pai de network e retorna o parent_id lido do banco já sob o lock.
+
+        Se outro escritor inseriu um pai mais específico enquanto esperávamos,
+        bloqueia também esse e repete até o pai ficar estável.
+        """
+        locked = set()
+        parent_id = most_specific_parent_id(db, network)
+        while parent_id not in locked:
+            self.lock_parent(db, parent_id, network.version)
+            locked.add(parent_id)
+            parent_id = most_specific_parent_id(db, network)
+        return parent_id
+
+    def watch(self, session_factory):
+        """Libera o lock de processo ao fim de cada transação das sessões do factory"""
+        if id(session_factory) in self._watched:
+            return
+        self._watched.add(id(session_factory))
+
+        @event.listens_for(session_factory, "after_transaction_end")
+        def release_process_lock(session, transaction):
+            if transaction.parent is None and session.info.pop("process_write_lock", False):
+                self._process_lock.release()
+
+
+def most_specific_parent_id(db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> Optional[int]:
+    """Prefixo mais específico que contém estritamente network, consultado no banco.
+
+    Os possíveis pais são exatamente as super-redes de network, então basta
+    procurá-las no índice único de prefix (no máximo 32/128 buscas indexadas).
+    """
+    supernets = [str(network.supernet(new_prefix=prefixlen)) for prefixlen in range(network.prefixlen)]
+    if not supernets:
+        return None
+    return db.query(IPPrefix.id).filter(
+        IPPrefix.prefix.in_(supernets)
+    ).order_by(IPPrefix.prefixlen.desc()).limit(1).scalar()
+
+
+write_locks = WriteLocks()
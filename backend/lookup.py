@@ -0,0 +1,145 @@
+"""
+Busca em lote do prefixo mais específico de cada endereço (POST /lookup).
+
+Os prefixos (que só se aninham ou são disjuntos) são achatados em segmentos
+contíguos: inícios ordenados e, para cada segmento, o prefixo mais específico
+que o cobre. Cada endereço vira então uma busca binária no array de inícios
+(numpy.searchsorted vetorizado para IPv4; bisect para IPv6, que não cabe em
+inteiros de 64 bits, ou quando o NumPy não está instalado). O índice é
+reconstruído quando a versão dos dados muda.
+"""
+
+import bisect
+import socket
+import threading
+from typing import List, Optional, Sequence
+from sqlalchemy.orm import Session
+from models import IPPrefix
+from versioned_cache import get_data_version
+
+try:
+    import numpy as np
+except ImportError:  # Dependência opcional: sem ela a busca usa bisect
+    np = None
+
+MAX_LOOKUP_ADDRESSES = 500000
+NO_OWNER = -1
+
+
+def parse_address(address: str):
+    """(versão, inteiro) do endereço, ou None se inválido"""
+    try:
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+    except (OSError, TypeError):
+        pass
+    try:
+        return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, address.split("%", 1)[0]), "big")
+    except (OSError, TypeError):
+        return None
+
+
+def flatten_segments(ranges: List[tuple]) -> tuple:
+    """(inícios, donos) dos segmentos a partir de (início, prefixlen, fim, índice) dos prefixos.
+
+    Varredura em ordem de início (menor máscara primeiro) com uma pilha dos
+    prefixos abertos: ao fechar um prefixo o segmento seguinte volta para o pai.
+    """
+    starts: List[int] = []
+    owners: List[int] = []
+
+    def emit(position: int, owner: int):
+        if starts and starts[-1] == position:
+            owners[-1] = owner
+        else:
+            starts.append(position)
+            owners.append(owner)
+
+    stack = []  # (fim, índice) dos prefixos abertos
+    for start, _, end, index in sorted(ranges):
+        while stack and stack[-1][0] < start:
+            closed_end, _ = stack.pop()
+            emit(closed_end + 1, stack[-1][1] if stack else NO_OWNER)
+        emit(start, index)
+        stack.append((end, index))
+    while stack:
+        closed_end, _ = stack.pop()
+        emit(closed_end + 1, stack[-1][1] if stack else NO_OWNER)
+    return starts, owners
+
+
+class FamilyIndex:
+    def __init__(self, starts: List[int], owners: List[int], vectorized: bool):
+        self.starts = starts
+        self.owners = owners
+        self.np_starts = np.array(starts, dtype=np.uint64) if vectorized else None
+        self.np_owners = np.array(owners, dtype=np.int64) if vectorized else None
+
+    def find(self, addresses: Sequence[int]) -> List[int]:
+        """Índice do prefixo dono de cada endereço (NO_OWNER se nenhum)"""
+        if not self.starts:
+            return [NO_OWNER] * len(addresses)
+        if self.np_starts is not None:
+            positions = np.searchsorted(self.np_starts, np.array(addresses, dtype=np.uint64), side="right") - 1
+            owners = np.where(positions >= 0, self.np_owners[np.maximum(positions, 0)], NO_OWNER)
+            return owners.tolist()
+
+        result = []
+        for address in addresses:
+            position = bisect.bisect_right(self.starts, address) - 1
+            result.append(self.owners[position] if position >= 0 else NO_OWNER)
+        return result
+
+
+class LookupIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version: Optional[int] = None
+        self._prefixes: List[dict] = []
+        self._families = {}
+
+    def _rebuild(self, db: Session, version: int):
+        rows = db.query(
+            IPPrefix.id, IPPrefix.prefix, IPPrefix.description, IPPrefix.usado,
+            IPPrefix.is_ipv6, IPPrefix.network_start, IPPrefix.network_end, IPPrefix.prefixlen
+        ).filter(IPPrefix.prefixlen.isnot(None)).all()
+
+        prefixes = []
+        ranges = {4: [], 6: []}
+        for row in rows:
+            ranges[6 if row.is_ipv6 else 4].append((row.network_start, row.prefixlen, row.network_end, len(prefixes)))
+            prefixes.append({"id": row.id, "prefix": row.prefix, "description": row.description, "usado": row.usado})
+
+        self._families = {
+            family: FamilyIndex(*flatten_segments(family_ranges), vectorized=np is not None and family == 4)
+            for family, family_ranges in ranges.items()
+        }
+        self._prefixes = prefixes
+        self._version = version
+
+    def lookup(self, db: Session, addresses: Sequence[str]) -> List[dict]:
+        """Prefixo mais específico (id, prefix, description, usado) de cada endereço, na ordem recebida"""
+        version = get_data_version(db)
+        with self._lock:
+            if self._version != version:
+                self._rebuild(db, version)
+            families, prefixes = self._families, self._prefixes
+
+        parsed = [parse_address(address) for address in addresses]
+        owners: List[int] = [NO_OWNER] * len(addresses)
+        for family, family_index in families.items():
+            positions = [i for i, item in enumerate(parsed) if item is not None and item[0] == family]
+            if not positions:
+                continue
+            for i, owner in zip(positions, family_index.find([parsed[i][1] for i in positions])):
+                owners[i] = owner
+
+        results = []
+        for address, item, owner in zip(addresses, parsed, owners):
+            if item is None:
+                results.append({"address": address, "prefix": None, "error": "Invalid IP address"})
+            else:
+                results.append({"address": address, "prefix": prefixes[owner] if owner != NO_OWNER else None})
+        return results
+
+
+lookup_index = LookupIndex()
@@ -1,33 +1,68 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy import and_, false, literal, or_, tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from collections import defaultdict
+from fractions import Fraction
+import anyio.to_thread
 import ipaddress
-from database import get_db, init_db
+import math
+import os
+from database import engine, get_db, init_db, SessionLocal
 from models import IPPrefix, User, UserRole
-from schemas import IPPrefixCreate, IPPrefixResponse, IPPrefixUpdate, SummaryResponse, SubnetResponse, DivideRequest, DivideResponse, UserCreate, UserLogin, UserResponse, AuthResponse, UserRoleUpdate, UserUpdate
+from hierarchy import MAX_FREE_BLOCKS, HierarchyBuilder, collapsed_children_count
+from rollup import query_in, refresh_rollups
+from bulk_import import import_prefixes, parse_bulk_payload
+from export import EXPORT_FORMATS, export_stream
+from lookup import MAX_LOOKUP_ADDRESSES, lookup_index
+from prefix_query import ORDER_COLUMNS, PREFIX_FIELDS, ancestors_query, decode_cursor, fetch_page, filter_conditions, parse_fields, prefixes_query, row_to_dict, subtree_conditions
+from divide import DIVIDE_SYNC_LIMIT, MAX_DIVIDE_SUBNETS, divide_job, divide_prefix_subnets, subnet_range_query
+from jobs import job_response, job_runner
+from free_space import free_space_index
+from locks import most_specific_parent_id, write_locks
+from reparent import adopt_children, release_children
+from pool import pool_status
+from fast_json import FastJSONResponse, dumps
+from metrics import MetricsMiddleware, metrics_registry, watch_engine
+from auth_cache import Principal, principal_cache
+from versioned_cache import bump_data_version, etag_matches, get_data_version, result_cache, version_etag
+from schemas import IPPrefixCreate, IPPrefixResponse, IPPrefixUpdate, SummaryResponse, SubnetResponse, DivideRequest, DivideResponse, AllocateRequest, AllocateResponse, LookupRequest, LookupResponse, BulkImportResponse, JobResponse, UserCreate, UserLogin, UserResponse, AuthResponse, UserRoleUpdate, UserUpdate
 
 app = FastAPI(title="IPAM - IP Address Management", version="1.0.0")
 
+# Os handlers são síncronos e rodam no threadpool do AnyIO, então uma consulta
+# lenta ocupa uma thread em vez de travar o event loop
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Next-Cursor", "X-Total-Count"],
 )
+app.add_middleware(MetricsMiddleware)
 
 @app.on_event("startup")
 async def startup_event():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
     init_db()
     create_default_admin_if_needed()
+    job_runner.recover()
+    free_space_index.watch(SessionLocal)
+    write_locks.watch(SessionLocal)
+    watch_engine(engine)
 
 @app.get("/")
 async def root():
     return {"message": "IPAM API is running"}
 
 @app.post("/auth/register", response_model=AuthResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+def register(user_data: UserCreate, db: Session = Depends(get_db)):
     """Cadastrar novo usuário"""
     # Verificar se email já existe
     existing_user = db.query(User).filter(User.email == user_data.email).first()
@@ -48,7 +83,7 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     )
 
 @app.post("/auth/login", response_model=AuthResponse)
-async def login(login_data: UserLogin, db: Session = Depends(get_db)):
+def login(login_data: UserLogin, db: Session = Depends(get_db)):
     """Login de usuário"""
     user = db.query(User).filter(User.email == login_data.email).first()
     if not user or not user.verify_password(login_data.password):
@@ -62,18 +97,25 @@ async def login(login_data: UserLogin, db: Session = Depends(get_db)):
         message="Login successful"
     )
 
-def get_current_user(user_email: str = Header(..., alias="X-User-Email"), db: Session = Depends(get_db)) -> User:
-    """Middleware para obter usuário atual baseado no header"""
-    user = db.query(User).filter(User.email == user_email).first()
+def get_current_user(user_email: str = Header(..., alias="X-User-Email"), db: Session = Depends(get_db)) -> Principal:
+    """Middleware para obter usuário atual baseado no header (com cache dos usuários ativos)"""
+    principal = principal_cache.get(user_email)
+    if principal is not None:
+        return principal
+
+    generation = principal_cache.generation
+    user = db.query(User.id, User.email, User.role, User.is_active).filter(User.email == user_email).first()
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     if not user.is_active:
         raise HTTPException(status_code=401, detail="User account is disabled")
-    return user
+    principal = Principal(*user)
+    principal_cache.put(principal, generation)
+    return principal
 
 def require_role(required_roles: List[UserRole]):
     """Decorator para verificar se o usuário tem a role necessária"""
-    def decorator(current_user: User = Depends(get_current_user)):
+    def decorator(current_user: Principal = Depends(get_current_user)):
         if current_user.role not in required_roles:
             raise HTTPException(
                 status_code=403, 
@@ -82,7 +124,7 @@ def require_role(required_roles: List[UserRole]):
         return current_user
     return decorator
 
-def require_operador_or_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_operador_or_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """Middleware que requer role OPERADOR ou ADMIN"""
     if current_user.role not in [UserRole.OPERADOR, UserRole.ADMIN]:
         raise HTTPException(
@@ -91,7 +133,7 @@ def require_operador_or_admin(current_user: User = Depends(get_current_user)) ->
         )
     return current_user
 
-def require_admin(current_user: User = Depends(get_current_user)) -> User:
+def require_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
     """Middleware que requer role ADMIN"""
     if current_user.role != UserRole.ADMIN:
         raise HTTPException(
@@ -101,13 +143,13 @@ def require_admin(current_user: User = Depends(get_current_user)) -> User:
     return current_user
 
 @app.get("/auth/users", response_model=List[UserResponse])
-async def get_users(current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def get_users(current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Listar todos os usuários (apenas ADMIN)"""
     users = db.query(User).all()
     return users
 
 @app.get("/auth/users/{user_id}", response_model=UserResponse)
-async def get_user(user_id: int, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def get_user(user_id: int, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Obter um usuário específico (apenas ADMIN)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -115,7 +157,7 @@ async def get_user(user_id: int, current_user: User = Depends(require_admin), db
     return user
 
 @app.put("/auth/users/{user_id}", response_model=UserResponse)
-async def update_user(user_id: int, user_data: UserUpdate, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def update_user(user_id: int, user_data: UserUpdate, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Atualizar usuário (apenas ADMIN)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -141,12 +183,13 @@ async def update_user(user_id: int, user_data: UserUpdate, current_user: User =
         user.is_active = user_data.is_active
     
     db.commit()
+    principal_cache.invalidate_user(user.id)
     db.refresh(user)
     
     return user
 
 @app.delete("/auth/users/{user_id}")
-async def delete_user(user_id: int, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def delete_user(user_id: int, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Deletar usuário (apenas ADMIN)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -158,11 +201,12 @@ async def delete_user(user_id: int, current_user: User = Depends(require_admin),
     
     db.delete(user)
     db.commit()
+    principal_cache.invalidate_user(user_id)
     
     return {"message": "User deleted successfully"}
 
 @app.put("/auth/users/{user_id}/role", response_model=UserResponse)
-async def update_user_role(user_id: int, role_data: UserRoleUpdate, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def update_user_role(user_id: int, role_data: UserRoleUpdate, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Atualizar role de um usuário (apenas ADMIN)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -170,12 +214,13 @@ async def update_user_role(user_id: int, role_data: UserRoleUpdate, current_user
     
     user.role = role_data.role
     db.commit()
+    principal_cache.invalidate_user(user.id)
     db.refresh(user)
     
     return user
 
 @app.put("/auth/users/{user_id}/status")
-async def toggle_user_status(user_id: int, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def toggle_user_status(user_id: int, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     """Ativar/desativar usuário (apenas ADMIN)"""
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
@@ -187,23 +232,24 @@ async def toggle_user_status(user_id: int, current_user: User = Depends(require_
     
     user.is_active = not user.is_active
     db.commit()
+    principal_cache.invalidate_user(user.id)
     db.refresh(user)
     
     return {"message": f"User {'activated' if user.is_active else 'deactivated'} successfully", "is_active": user.is_active}
 
 @app.post("/prefixes", response_model=IPPrefixResponse)
-async def create_prefix(prefix_data: IPPrefixCreate, current_user: User = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+def create_prefix(prefix_data: IPPrefixCreate, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
     try:
         network = ipaddress.ip_network(prefix_data.prefix, strict=False)
         
+        # Bloquear o pai antes de verificar/inserir (escritores paralelos)
+        parent_id = write_locks.lock_parent_of(db, network)
+        
         # Verificar se já existe
         existing = db.query(IPPrefix).filter(IPPrefix.prefix == str(network)).first()
         if existing:
             raise HTTPException(status_code=400, detail="Prefix already exists")
         
-        # Encontrar prefixo pai automaticamente
-        parent_id = find_parent_prefix(db, network)
-        
         prefix = IPPrefix(
             prefix=str(network),
             description=prefix_data.description,
@@ -215,6 +261,11 @@ async def create_prefix(prefix_data: IPPrefixCreate, current_user: User = Depend
         )
         
         db.add(prefix)
+        db.flush()
+        # Filhos já existentes do pai que caem dentro do novo prefixo passam para ele
+        adopt_children(db, prefix.id, parent_id, network)
+        refresh_rollups(db, [prefix.id])
+        bump_data_version(db)
         db.commit()
         db.refresh(prefix)
         
@@ -223,11 +274,14 @@ async def create_prefix(prefix_data: IPPrefixCreate, current_user: User = Depend
         raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {str(e)}")
 
 @app.post("/prefixes/with-hierarchy", response_model=IPPrefixResponse)
-async def create_prefix_with_hierarchy(prefix_data: IPPrefixCreate, current_user: User = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+def create_prefix_with_hierarchy(prefix_data: IPPrefixCreate, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
     """Cria um prefixo criando automaticamente toda a hierarquia intermediária necessária"""
     try:
         network = ipaddress.ip_network(prefix_data.prefix, strict=False)
         
+        # Bloquear o pai antes de verificar/inserir (escritores paralelos)
+        write_locks.lock_parent_of(db, network)
+        
         # Verificar se já existe
         existing = db.query(IPPrefix).filter(IPPrefix.prefix == str(network)).first()
         if existing:
@@ -237,6 +291,8 @@ async def create_prefix_with_hierarchy(prefix_data: IPPrefixCreate, current_user
                 existing.description = prefix_data.description
                 existing.usado = prefix_data.usado
                 existing.is_auto_created = prefix_data.is_auto_created
+                refresh_rollups(db, [existing.id])
+                bump_data_version(db)
                 db.commit()
                 db.refresh(existing)
             return existing
@@ -244,6 +300,8 @@ async def create_prefix_with_hierarchy(prefix_data: IPPrefixCreate, current_user
         # Criar toda a hierarquia intermediária
         target_id = create_intermediate_prefixes(db, network, prefix_data.description, prefix_data.usado, current_user.id)
         
+        refresh_rollups(db, [target_id])
+        bump_data_version(db)
         db.commit()
         
         # Retornar o prefixo criado
@@ -253,20 +311,119 @@ async def create_prefix_with_hierarchy(prefix_data: IPPrefixCreate, current_user
     except ValueError as e:
         raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {str(e)}")
 
+async def read_body(request: Request) -> bytes:
+    """Corpo cru da requisição, lido no event loop para o handler síncrono"""
+    return await request.body()
+
+@app.post("/prefixes/bulk", response_model=BulkImportResponse)
+def bulk_import(body: bytes = Depends(read_body), content_type: Optional[str] = Header(None),
+                current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+    """Importa prefixos em lote (JSON ou CSV com prefix,description,usado) em uma única transação.
+
+    Linhas inválidas ou duplicadas são reportadas e ignoradas; as demais são gravadas.
+    """
+    try:
+        rows = parse_bulk_payload(body, content_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid bulk payload: {str(e)}")
+    
+    try:
+        report = import_prefixes(db, rows, current_user.id)
+        if report.created:
+            bump_data_version(db)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Concurrent modification of the same prefixes, please retry")
+    return report
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 1000
+
+def wants_ndjson(accept: Optional[str]) -> bool:
+    """Indica se o cliente pediu a resposta em streaming (uma linha JSON por item)"""
+    return bool(accept) and NDJSON_MEDIA_TYPE in accept
+
+def stream_prefixes_ndjson():
+    """Emite os prefixos linha a linha a partir de um cursor no servidor (memória constante)"""
+    db = SessionLocal()
+    try:
+        query = db.query(*[getattr(IPPrefix, field) for field in PREFIX_FIELDS]).order_by(IPPrefix.id)
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            yield dumps(row_to_dict(row, PREFIX_FIELDS)) + b"\n"
+    finally:
+        db.close()
+
+def stream_filtered_ndjson(fields: List[str], conditions: list, cursor: Optional[str]):
+    """Como stream_prefixes_ndjson, mas só com as colunas pedidas e em ordem de endereço"""
+    db = SessionLocal()
+    try:
+        for row in prefixes_query(db, fields, conditions, cursor).yield_per(STREAM_BATCH_SIZE):
+            yield dumps(row_to_dict(row, fields)) + b"\n"
+    finally:
+        db.close()
+
+def stream_hierarchy_ndjson(depth: Optional[int], mode: str, max_free_blocks: int):
+    """Emite cada árvore root assim que seu lote de roots é carregado (memória limitada ao lote)"""
+    db = SessionLocal()
+    try:
+        for node in iter_hierarchy(db, depth, mode, max_free_blocks):
+            yield dumps(node) + b"\n"
+    finally:
+        db.close()
+
+MAX_PREFIXES_LIMIT = 10000
+
 @app.get("/prefixes", response_model=List[IPPrefixResponse])
-async def get_prefixes(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    prefixes = db.query(IPPrefix).all()
-    return prefixes
+def get_prefixes(accept: Optional[str] = Header(None),
+                 family: Optional[int] = None,
+                 usado: Optional[bool] = None, is_auto_created: Optional[bool] = None,
+                 user_id: Optional[int] = None, parent_id: Optional[int] = None,
+                 within: Optional[str] = None, fields: Optional[str] = None,
+                 limit: Optional[int] = Query(None, ge=1, le=MAX_PREFIXES_LIMIT), cursor: Optional[str] = None,
+                 current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Lista os prefixos.
+
+    Filtros: family (4/6), usado, is_auto_created, user_id, parent_id e within
+    (contidos no CIDR). fields=prefix,description devolve apenas essas colunas.
+    Com limit a lista é paginada em ordem de endereço: o header X-Next-Cursor
+    traz o cursor da próxima página (?cursor=...), ausente na última.
+    """
+    if family not in (None, 4, 6):
+        raise HTTPException(status_code=400, detail="family must be 4 or 6")
+    try:
+        conditions = filter_conditions(family, usado, is_auto_created, user_id, parent_id, within)
+        selected_fields = parse_fields(fields)
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if not (conditions or fields or limit or cursor):
+        if wants_ndjson(accept):
+            return StreamingResponse(stream_prefixes_ndjson(), media_type=NDJSON_MEDIA_TYPE)
+        # Apenas as colunas da resposta, em dicts, sem carregar objetos do ORM nem revalidar
+        rows = db.query(*[getattr(IPPrefix, field) for field in PREFIX_FIELDS]).all()
+        return FastJSONResponse(content=[row_to_dict(row, PREFIX_FIELDS) for row in rows])
+    
+    if wants_ndjson(accept) and limit is None:
+        return StreamingResponse(
+            stream_filtered_ndjson(selected_fields, conditions, cursor), media_type=NDJSON_MEDIA_TYPE
+        )
+    
+    items, next_cursor = fetch_page(db, selected_fields, conditions, limit, cursor)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return FastJSONResponse(content=items, headers=headers)
 
 @app.get("/prefixes/{prefix_id}", response_model=IPPrefixResponse)
-async def get_prefix(prefix_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_prefix(prefix_id: int, current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
     prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
     if not prefix:
         raise HTTPException(status_code=404, detail="Prefix not found")
     return prefix
 
 @app.put("/prefixes/{prefix_id}", response_model=IPPrefixResponse)
-async def update_prefix(prefix_id: int, prefix_data: IPPrefixUpdate, current_user: User = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+def update_prefix(prefix_id: int, prefix_data: IPPrefixUpdate, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
     prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
     if not prefix:
         raise HTTPException(status_code=404, detail="Prefix not found")
@@ -280,53 +437,375 @@ async def update_prefix(prefix_id: int, prefix_data: IPPrefixUpdate, current_use
     if prefix_data.is_auto_created is not None:
         prefix.is_auto_created = prefix_data.is_auto_created
     
+    if prefix_data.usado is not None:
+        refresh_rollups(db, [prefix.id])
+    bump_data_version(db)
     db.commit()
     db.refresh(prefix)
     return prefix
 
 @app.delete("/prefixes/{prefix_id}")
-async def delete_prefix(prefix_id: int, current_user: User = Depends(require_admin), db: Session = Depends(get_db)):
+def delete_prefix(prefix_id: int, current_user: Principal = Depends(require_admin), db: Session = Depends(get_db)):
     prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
     if not prefix:
         raise HTTPException(status_code=404, detail="Prefix not found")
     
+    # Bloquear o pai (que recebe os filhos) e o próprio prefixo, do ancestral para o descendente.
+    # O parent_id é relido sob o lock: se outro escritor inseriu um pai mais
+    # específico enquanto esperávamos, bloqueia também esse e repete
+    version = 6 if prefix.is_ipv6 else 4
+    locked = set()
+    parent_id = prefix.parent_id
+    while parent_id not in locked:
+        write_locks.lock_parent(db, parent_id, version)
+        locked.add(parent_id)
+        row = db.query(IPPrefix.parent_id).filter(IPPrefix.id == prefix_id).first()
+        if row is None:
+            raise HTTPException(status_code=404, detail="Prefix not found")
+        parent_id = row.parent_id
+    write_locks.lock_parent(db, prefix.id, version)
+    db.refresh(prefix)
+    release_children(db, prefix)
     db.delete(prefix)
+    refresh_rollups(db, [parent_id])
+    bump_data_version(db)
     db.commit()
     return {"message": "Prefix deleted successfully"}
 
 @app.get("/prefixes/{prefix_id}/children", response_model=List[IPPrefixResponse])
-async def get_prefix_children(prefix_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_prefix_children(prefix_id: int, current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
     children = db.query(IPPrefix).filter(IPPrefix.parent_id == prefix_id).all()
     return children
 
+def get_indexed_prefix(db: Session, prefix_id: int) -> IPPrefix:
+    """Prefixo pelo id, com a faixa numérica preenchida (necessária para subtree/ancestors)"""
+    prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
+    if not prefix:
+        raise HTTPException(status_code=404, detail="Prefix not found")
+    if prefix.prefixlen is None:
+        raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {prefix.prefix}")
+    return prefix
+
+@app.get("/prefixes/{prefix_id}/subtree", response_model=List[IPPrefixResponse])
+def get_prefix_subtree(prefix_id: int, accept: Optional[str] = Header(None), fields: Optional[str] = None,
+                       limit: Optional[int] = Query(None, ge=1, le=MAX_PREFIXES_LIMIT), cursor: Optional[str] = None,
+                       current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Todos os descendentes do prefixo, em qualquer nível, em ordem de endereço.
+
+    Uma consulta de faixa indexada, independente da profundidade; fields, limit,
+    cursor e Accept: application/x-ndjson funcionam como em GET /prefixes.
+    """
+    prefix = get_indexed_prefix(db, prefix_id)
+    try:
+        selected_fields = parse_fields(fields)
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    conditions = subtree_conditions(prefix)
+    
+    if wants_ndjson(accept) and limit is None:
+        return StreamingResponse(
+            stream_filtered_ndjson(selected_fields, conditions, cursor), media_type=NDJSON_MEDIA_TYPE
+        )
+    
+    items, next_cursor = fetch_page(db, selected_fields, conditions, limit, cursor)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    return FastJSONResponse(content=items, headers=headers)
+
+@app.get("/prefixes/{prefix_id}/ancestors", response_model=List[IPPrefixResponse])
+def get_prefix_ancestors(prefix_id: int, fields: Optional[str] = None,
+                         current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Prefixos que contêm o prefixo, do root ao pai imediato, em uma única consulta"""
+    prefix = get_indexed_prefix(db, prefix_id)
+    try:
+        selected_fields = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    rows = ancestors_query(db, selected_fields, ipaddress.ip_network(prefix.prefix)).all()
+    return FastJSONResponse(content=[row_to_dict(row, selected_fields) for row in rows])
+
+@app.get("/export")
+def export_prefixes(export_format: str = Query("csv", alias="format", pattern="^(csv|ndjson)$"),
+                          utilization: bool = False, gzip: bool = False,
+                          current_user: Principal = Depends(get_current_user)):
+    """Exporta todos os prefixos em streaming (CSV ou NDJSON), com memória constante.
+
+    utilization inclui os agregados calculados (endereços usados, status);
+    gzip comprime a saída durante o envio.
+    """
+    media_type, extension = EXPORT_FORMATS[export_format]
+    filename = f"prefixes.{extension}"
+    if gzip:
+        media_type = "application/gzip"
+        filename += ".gz"
+    
+    return StreamingResponse(
+        export_stream(export_format, utilization, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+def cache_headers(etag: str) -> dict:
+    """Headers que fazem o navegador revalidar sempre (If-None-Match) antes de reutilizar"""
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers=cache_headers(etag))
+
+MAX_SUMMARY_LIMIT = 10000
+
 @app.get("/summary", response_model=List[SummaryResponse])
-async def get_summary(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    prefixes = db.query(IPPrefix).all()
-    summary = calculate_prefix_summary(prefixes)
-    return summary
+def get_summary(root: Optional[str] = None,
+                min_utilization: Optional[float] = Query(None, ge=0, le=100),
+                limit: Optional[int] = Query(None, ge=1, le=MAX_SUMMARY_LIMIT), offset: int = Query(0, ge=0),
+                if_none_match: Optional[str] = Header(None),
+                current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Resumo de utilização lido das colunas de rollup, filtrado e paginado no banco.
+
+    root (id ou CIDR) restringe ao prefixo e seus descendentes, min_utilization
+    (0-100) às linhas com pelo menos essa utilização; com limit/offset o total
+    de linhas vem no header X-Total-Count.
+    """
+    version = get_data_version(db)
+    etag = version_etag(version)
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+    headers = cache_headers(etag)
+    
+    def compute():
+        # Guardado já codificado: o cache conta bytes e os acertos não serializam de novo
+        query = summary_query(db, root, min_utilization)
+        if limit is None and not offset:
+            rows = query.all()
+            return len(rows), dumps(calculate_prefix_summary(rows))
+        return query.order_by(None).count(), dumps(calculate_prefix_summary(query.offset(offset).limit(limit).all()))
+    
+    total, body = result_cache.get_or_compute(
+        ("summary", root, min_utilization, limit, offset), version, compute, size=lambda result: len(result[1])
+    )
+    if limit is not None or offset:
+        headers["X-Total-Count"] = str(total)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+SUMMARY_COLUMNS = (
+    IPPrefix.prefix, IPPrefix.description, IPPrefix.is_ipv6, IPPrefix.prefixlen,
+    IPPrefix.child_addresses, IPPrefix.child_count
+)
+
+def summary_query(db: Session, root: Optional[str], min_utilization: Optional[float]):
+    """Linhas do resumo (apenas as colunas necessárias), ordenadas por id"""
+    query = db.query(*SUMMARY_COLUMNS).filter(IPPrefix.prefixlen.isnot(None))
+    
+    if root is not None:
+        container, calculated_network = resolve_hierarchy_root(db, root)
+        if calculated_network is not None:
+            raise HTTPException(status_code=404, detail="Prefix not found")
+        query = query.filter(
+            IPPrefix.is_ipv6 == container.is_ipv6,
+            IPPrefix.network_start >= container.network_start,
+            IPPrefix.network_end <= container.network_end,
+            IPPrefix.prefixlen >= container.prefixlen
+        )
+    
+    if min_utilization:
+        # Limiares só para as máscaras presentes no recorte, não para as 162 possíveis
+        lengths = query.with_entities(IPPrefix.is_ipv6, IPPrefix.prefixlen).distinct().all()
+        conditions = utilization_conditions(min_utilization, lengths)
+        query = query.filter(or_(*conditions) if conditions else false())
+    
+    return query.order_by(IPPrefix.id)
+
+def utilization_conditions(min_utilization: float, lengths) -> list:
+    """utilização >= min_utilization como child_addresses >= limiar, um limiar inteiro por máscara.
+
+    lengths são os pares (is_ipv6, prefixlen) a cobrir. Assim o filtro roda no
+    banco sem dividir números de 128 bits em SQL.
+    """
+    ratio = Fraction(str(min_utilization)) / 100
+    conditions = []
+    for is_ipv6, prefixlen in sorted(lengths):
+        max_bits = 128 if is_ipv6 else 32
+        threshold = math.ceil(ratio * 2 ** (max_bits - prefixlen))
+        conditions.append(and_(
+            IPPrefix.is_ipv6 == is_ipv6,
+            IPPrefix.prefixlen == prefixlen,
+            IPPrefix.child_addresses >= threshold
+        ))
+    return conditions
 
 @app.get("/hierarchy", response_model=List[SubnetResponse])
-async def get_hierarchy(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Retorna hierarquia completa com sub-redes calculadas"""
-    prefixes = db.query(IPPrefix).all()
-    hierarchy = build_subnet_hierarchy(prefixes)
-    return hierarchy
+def get_hierarchy(root: Optional[str] = None, depth: Optional[int] = Query(None, ge=0),
+                        mode: str = Query("binary", pattern="^(binary|compact)$"),
+                        max_free_blocks: int = Query(MAX_FREE_BLOCKS, ge=1),
+                        accept: Optional[str] = Header(None), if_none_match: Optional[str] = Header(None),
+                        current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Retorna hierarquia com sub-redes calculadas.
+
+    root (id ou CIDR) restringe a resposta a um nó e depth limita quantos níveis
+    de filhos são expandidos; nós recolhidos trazem apenas agregados e children_count.
+    mode=compact troca as metades bit a bit pelos blocos livres mínimos entre os
+    filhos reais, no máximo max_free_blocks por pai.
+    Com Accept: application/x-ndjson cada árvore root é enviada em uma linha.
+    O resultado fica em cache até a próxima alteração de prefixos (ETag/304).
+    """
+    version = get_data_version(db)
+    etag = version_etag(version)
+    if etag_matches(if_none_match, etag):
+        return not_modified_response(etag)
+    
+    if root is None and wants_ndjson(accept):
+        # Uma linha por árvore root, geradas lote a lote
+        return StreamingResponse(
+            stream_hierarchy_ndjson(depth, mode, max_free_blocks),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=cache_headers(etag)
+        )
+    
+    # Cada árvore root fica em cache já codificada (nós no formato de SubnetResponse,
+    # sem revalidar contra o response_model); o cache conta os bytes
+    encoded_roots = result_cache.get_or_compute(
+        ("hierarchy", root, depth, mode, max_free_blocks), version,
+        lambda: [dumps(node) for node in compute_hierarchy(db, root, depth, mode, max_free_blocks)],
+        size=lambda lines: sum(len(line) for line in lines)
+    )
+    if wants_ndjson(accept):
+        return StreamingResponse(
+            (line + b"\n" for line in encoded_roots),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=cache_headers(etag)
+        )
+    return Response(content=b"[" + b",".join(encoded_roots) + b"]", media_type="application/json",
+                    headers=cache_headers(etag))
+
+def compute_hierarchy(db: Session, root: Optional[str], depth: Optional[int],
+                      mode: str = "binary", max_free_blocks: int = MAX_FREE_BLOCKS) -> List[dict]:
+    """Calcula a hierarquia completa ou apenas o nó root (id ou CIDR)"""
+    if root is None:
+        return list(iter_hierarchy(db, depth, mode, max_free_blocks))
+    
+    container, calculated_network = resolve_hierarchy_root(db, root)
+    if calculated_network is not None:
+        # Apenas o prefixo real e o que está dentro da sub-rede calculada
+        prefixes = [container] + contained_prefixes_query(db, calculated_network).all()
+        builder = HierarchyBuilder(prefixes, mode, max_free_blocks, rollups=True)
+        return [builder.expand_calculated(calculated_network, container.id, depth)]
+    return subtree_nodes(db, [container], depth, mode, max_free_blocks)
+
+HIERARCHY_ROOT_BATCH = 100
+
+def iter_hierarchy(db: Session, depth: Optional[int], mode: str = "binary",
+                   max_free_blocks: int = MAX_FREE_BLOCKS):
+    """Gera as árvores root em ordem de endereço, carregando HIERARCHY_ROOT_BATCH roots por vez (keyset)"""
+    roots_query = db.query(IPPrefix).filter(IPPrefix.parent_id.is_(None))
+    key = None
+    while True:
+        query = roots_query.filter(IPPrefix.prefixlen.isnot(None))
+        if key is not None:
+            query = query.filter(tuple_(*ORDER_COLUMNS) > tuple_(*key))
+        roots = query.order_by(*ORDER_COLUMNS).limit(HIERARCHY_ROOT_BATCH).all()
+        if not roots:
+            break
+        yield from subtree_nodes(db, roots, depth, mode, max_free_blocks)
+        key = [literal(getattr(roots[-1], column.key), column.type) for column in ORDER_COLUMNS]
+    
+    # Prefixos com texto inválido aparecem no fim, como nós de erro
+    yield from HierarchyBuilder(roots_query.filter(IPPrefix.prefixlen.is_(None)).all(), mode).iter_roots(depth)
+
+def subtree_nodes(db: Session, roots: List[IPPrefix], depth: Optional[int], mode: str = "binary",
+                  max_free_blocks: int = MAX_FREE_BLOCKS) -> List[dict]:
+    """Árvores dos roots dados, carregando só os níveis exibidos; agregados vêm dos rollups"""
+    prefixes, collapsed = load_levels(db, roots, depth)
+    builder = HierarchyBuilder(prefixes, mode, max_free_blocks, rollups=True,
+                               collapsed_counts=collapsed_counts(db, collapsed, mode))
+    return [builder.build_subnet_tree(root, depth) for root in roots]
+
+def load_levels(db: Session, roots: List[IPPrefix], depth: Optional[int]):
+    """Prefixos dos roots e de até depth níveis abaixo (None = todos), seguindo parent_id nível a nível.
+
+    Retorna também o último nível carregado quando ele fica recolhido no limite de depth.
+    """
+    prefixes = list(roots)
+    level = roots
+    remaining = depth
+    while level and remaining != 0:
+        level = query_in(db, IPPrefix.parent_id, [prefix.id for prefix in level])
+        prefixes.extend(level)
+        remaining = None if remaining is None else remaining - 1
+    return prefixes, level
+
+def collapsed_counts(db: Session, prefixes: List[IPPrefix], mode: str = "binary") -> dict:
+    """children_count dos nós recolhidos a partir de child_count.
+
+    No modo binary basta saber quais metades já são filhos reais; só o modo
+    compact lê o texto dos filhos diretos para contar os blocos livres.
+    """
+    counts = {prefix.id: 0 for prefix in prefixes}
+    networks = {}
+    for prefix in prefixes:
+        if prefix.child_count:
+            try:
+                networks[prefix.id] = ipaddress.ip_network(prefix.prefix)
+            except ValueError:
+                continue
+    
+    children = defaultdict(list)
+    if mode == "compact":
+        for child in query_in(db, IPPrefix.parent_id, list(networks), (IPPrefix.parent_id, IPPrefix.prefix)):
+            children[child.parent_id].append(child)
+    else:
+        halves = [
+            str(half) for network in networks.values() if network.prefixlen < network.max_prefixlen
+            for half in network.subnets(new_prefix=network.prefixlen + 1)
+        ]
+        for child in query_in(db, IPPrefix.prefix, halves, (IPPrefix.parent_id, IPPrefix.prefix)):
+            children[child.parent_id].append(child)
+    
+    for prefix in prefixes:
+        if prefix.id in networks:
+            counts[prefix.id] = collapsed_children_count(networks[prefix.id], prefix.child_count,
+                                                         children[prefix.id], mode)
+    return counts
+
+def resolve_hierarchy_root(db: Session, root: str):
+    """Resolve root (id ou CIDR) no prefixo real correspondente ou que contém a sub-rede calculada"""
+    if root.isdigit():
+        prefix = db.query(IPPrefix).filter(IPPrefix.id == int(root)).first()
+        if not prefix:
+            raise HTTPException(status_code=404, detail="Prefix not found")
+        return prefix, None
+    
+    try:
+        network = ipaddress.ip_network(root, strict=False)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {str(e)}")
+    
+    prefix = db.query(IPPrefix).filter(IPPrefix.prefix == str(network)).first()
+    if prefix:
+        return prefix, None
+    
+    # Sub-rede calculada: pertence ao prefixo real mais específico que a contém
+    container = containing_prefixes_query(db, network).order_by(IPPrefix.prefixlen.desc()).first()
+    if not container:
+        raise HTTPException(status_code=404, detail="Prefix not found")
+    return container, network
 
 
 @app.post("/prefixes/create-from-calculated", response_model=IPPrefixResponse)
-async def create_from_calculated(prefix_data: IPPrefixCreate, current_user: User = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+def create_from_calculated(prefix_data: IPPrefixCreate, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
     """Converte um prefixo calculado em real criando-o no banco"""
     try:
         network = ipaddress.ip_network(prefix_data.prefix, strict=False)
         
+        # Bloquear o pai antes de verificar/inserir (escritores paralelos)
+        parent_id = write_locks.lock_parent_of(db, network)
+        
         # Verificar se já existe
         existing = db.query(IPPrefix).filter(IPPrefix.prefix == str(network)).first()
         if existing:
             return existing
         
-        # Encontrar prefixo pai automaticamente
-        parent_id = find_parent_prefix(db, network)
-        
         prefix = IPPrefix(
             prefix=str(network),
             description=prefix_data.description,
@@ -338,6 +817,11 @@ async def create_from_calculated(prefix_data: IPPrefixCreate, current_user: User
         )
         
         db.add(prefix)
+        db.flush()
+        # Filhos já existentes do pai que caem dentro do novo prefixo passam para ele
+        adopt_children(db, prefix.id, parent_id, network)
+        refresh_rollups(db, [prefix.id])
+        bump_data_version(db)
         db.commit()
         db.refresh(prefix)
         
@@ -347,25 +831,23 @@ async def create_from_calculated(prefix_data: IPPrefixCreate, current_user: User
 
 
 
-def find_parent_prefix(db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> Optional[int]:
-    """Encontra o prefixo pai mais específico para o novo prefixo"""
-    prefixes = db.query(IPPrefix).filter(
-        IPPrefix.is_ipv6 == (network.version == 6)
-    ).all()
-    
-    best_parent = None
-    best_prefix_len = -1
-    
-    for prefix in prefixes:
-        try:
-            prefix_network = ipaddress.ip_network(prefix.prefix)
-            if network.subnet_of(prefix_network) and prefix_network.prefixlen > best_prefix_len:
-                best_parent = prefix.id
-                best_prefix_len = prefix_network.prefixlen
-        except ValueError:
-            continue
-    
-    return best_parent
+def containing_prefixes_query(db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network):
+    """Prefixos que contêm estritamente a rede (consulta de faixa indexada)"""
+    return db.query(IPPrefix).filter(
+        IPPrefix.is_ipv6 == (network.version == 6),
+        IPPrefix.network_start <= int(network.network_address),
+        IPPrefix.network_end >= int(network.broadcast_address),
+        IPPrefix.prefixlen < network.prefixlen
+    )
+
+def contained_prefixes_query(db: Session, network: ipaddress.IPv4Network | ipaddress.IPv6Network):
+    """Prefixos contidos estritamente na rede (consulta de faixa indexada)"""
+    return db.query(IPPrefix).filter(
+        IPPrefix.is_ipv6 == (network.version == 6),
+        IPPrefix.network_start >= int(network.network_address),
+        IPPrefix.network_end <= int(network.broadcast_address),
+        IPPrefix.prefixlen > network.prefixlen
+    )
 
 def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Network | ipaddress.IPv6Network, 
                                target_description: str, target_usado: bool = False, user_id: int = None) -> int:
@@ -374,43 +856,24 @@ def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Netw
     # Verificar se já existe algum prefixo relacionado (pai ou filho)
     has_related_prefix = False
     
-    # Buscar por prefixos pais existentes
-    parent_prefix = None
+    # Buscar por prefixos pais existentes (o mais específico, sem ir além de /8)
+    parent_prefix = containing_prefixes_query(db, target_network).filter(
+        IPPrefix.prefixlen >= 8
+    ).order_by(IPPrefix.prefixlen.desc()).first()
     parent_network = None
     
-    for prefix_len in range(target_network.prefixlen - 1, 7, -1):  # Não ir além de /8 para IPv4
-        candidate_network = target_network.supernet(new_prefix=prefix_len)
-        existing = db.query(IPPrefix).filter(
-            IPPrefix.prefix == str(candidate_network),
-            IPPrefix.is_ipv6 == (target_network.version == 6)
-        ).first()
-        
-        if existing:
-            parent_prefix = existing
-            parent_network = candidate_network
-            has_related_prefix = True
-            break
+    if parent_prefix:
+        parent_network = ipaddress.ip_network(parent_prefix.prefix)
+        has_related_prefix = True
     
-    # Buscar por prefixos filhos existentes
+    # Buscar por prefixos filhos existentes (contidos no target)
     if not has_related_prefix:
-        children = db.query(IPPrefix).filter(
-            IPPrefix.is_ipv6 == (target_network.version == 6)
-        ).all()
-        
-        for child in children:
-            try:
-                child_network = ipaddress.ip_network(child.prefix)
-                # Verificar se o child está contido no target (target seria pai do child)
-                if child_network.subnet_of(target_network):
-                    has_related_prefix = True
-                    break
-            except ValueError:
-                continue
+        has_related_prefix = contained_prefixes_query(db, target_network).with_entities(IPPrefix.id).first() is not None
     
     # Se não há prefixos relacionados, criar apenas o prefixo solicitado sem hierarquia
     if not has_related_prefix:
-        # Usar o find_parent_prefix normal que só conecta a pais existentes
-        parent_id = find_parent_prefix(db, target_network)
+        # Conectar apenas a pais existentes
+        parent_id = most_specific_parent_id(db, target_network)
         
         target_prefix = IPPrefix(
             prefix=str(target_network),
@@ -423,12 +886,16 @@ def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Netw
         )
         db.add(target_prefix)
         db.flush()
+        adopt_children(db, target_prefix.id, parent_id, target_network)
         return target_prefix.id
     
     # Se há um pai existente, criar apenas os níveis intermediários necessários
     if parent_prefix:
         current_parent = parent_prefix
         current_prefix_len = parent_network.prefixlen
+        # O pai atual pode ter filhos já existentes dentro do próximo nível? Um
+        # intermediário recém-criado só tem os que acabou de adotar
+        may_adopt = True
         
         # Criar cada nível intermediário um por um
         for next_len in range(current_prefix_len + 1, target_network.prefixlen):
@@ -443,6 +910,7 @@ def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Netw
             
             if existing:
                 current_parent = existing
+                may_adopt = True
             else:
                 # Criar prefixo intermediário
                 inter_prefix = IPPrefix(
@@ -456,12 +924,14 @@ def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Netw
                 )
                 db.add(inter_prefix)
                 db.flush()
+                may_adopt = may_adopt and adopt_children(db, inter_prefix.id, current_parent.id, inter_network) > 0
                 current_parent = inter_prefix
         
         parent_id = current_parent.id
     else:
-        # Se há filhos mas não pai, usar find_parent_prefix normal
-        parent_id = find_parent_prefix(db, target_network)
+        # Se há filhos mas não pai, conectar ao pai existente mais específico
+        parent_id = most_specific_parent_id(db, target_network)
+        may_adopt = True
     
     # Finalmente criar o prefixo alvo
     target_prefix = IPPrefix(
@@ -475,470 +945,219 @@ def create_intermediate_prefixes(db: Session, target_network: ipaddress.IPv4Netw
     )
     db.add(target_prefix)
     db.flush()
+    if may_adopt:
+        adopt_children(db, target_prefix.id, parent_id, target_network)
     
     return target_prefix.id
 
-def calculate_prefix_summary(prefixes: List[IPPrefix]) -> List[SummaryResponse]:
-    """Calcula sumarização de prefixos usados"""
+def calculate_prefix_summary(prefixes: List[IPPrefix]) -> List[dict]:
+    """Calcula sumarização de prefixos (ou linhas de SUMMARY_COLUMNS) a partir das colunas de rollup.
+
+    Linhas como dicts simples no formato de SummaryResponse, serializadas sem revalidação.
+    """
     summary = []
     
     for prefix in prefixes:
-        try:
-            network = ipaddress.ip_network(prefix.prefix)
-            children = [p for p in prefixes if p.parent_id == prefix.id]
-            
-            total_addresses = int(network.num_addresses)
-            used_addresses = 0
-            
-            for child in children:
-                child_network = ipaddress.ip_network(child.prefix)
-                used_addresses += int(child_network.num_addresses)
-            
-            available_addresses = total_addresses - used_addresses
-            
-            summary.append(SummaryResponse(
-                prefix=prefix.prefix,
-                description=prefix.description,
-                total_addresses=total_addresses,
-                used_addresses=used_addresses,
-                available_addresses=available_addresses,
-                utilization_percent=round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0,
-                children_count=len(children)
-            ))
-        except ValueError:
+        if prefix.prefixlen is None:
             continue
+        
+        total_addresses = 2 ** ((128 if prefix.is_ipv6 else 32) - prefix.prefixlen)
+        used_addresses = prefix.child_addresses or 0
+        available_addresses = total_addresses - used_addresses
+        
+        summary.append({
+            "prefix": prefix.prefix,
+            "description": prefix.description,
+            "total_addresses": total_addresses,
+            "used_addresses": used_addresses,
+            "available_addresses": available_addresses,
+            "utilization_percent": round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0.0,
+            "children_count": prefix.child_count
+        })
     
     return summary
 
-def build_subnet_hierarchy(prefixes: List[IPPrefix]) -> List[SubnetResponse]:
-    """Constrói hierarquia completa com sub-redes automáticas"""
-    # Mapear prefixos reais por string
-    real_prefixes = {p.prefix: p for p in prefixes}
-    
-    # Construir árvore apenas com prefixos root (sem pai) e ordená-los
-    root_prefixes = [p for p in prefixes if p.parent_id is None]
-    root_prefixes.sort(key=lambda p: ipaddress.ip_network(p.prefix).network_address)
-    
-    hierarchy = []
-    for root in root_prefixes:
-        subnet_tree = build_subnet_tree(root, real_prefixes, prefixes)
-        hierarchy.append(subnet_tree)
-    
-    return hierarchy
+@app.post("/prefixes/{prefix_id}/divide", response_model=DivideResponse, responses={202: {"model": JobResponse}})
+def divide_prefix(prefix_id: int, request: DivideRequest, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+    """Divide um prefixo em sub-redes com a maior máscara possível.
 
-def calculate_status_from_children(prefix: IPPrefix, children: List[SubnetResponse]) -> str:
-    """Calcula o status baseado nos filhos (incluindo sub-redes calculadas)"""
-    # Se está marcado como usado, retorna "usado"
-    if prefix.usado:
-        return "usado"
-    
-    # Se não tem filhos, está livre
-    if not children:
-        return "livre"
-    
-    # Verificar status de todos os filhos
-    children_status = [child.status for child in children]
-    
-    # Se TODOS os filhos estão usados, pai fica usado
-    if all(status == "usado" for status in children_status):
-        return "usado"
-    
-    # Se algum filho está usado ou parcialmente usado, pai fica parcialmente usado
-    if any(status in ["usado", "parcialmente_usado"] for status in children_status):
-        return "parcialmente_usado"
-    
-    return "livre"
-
-def calculate_status(prefix: IPPrefix, all_prefixes: List[IPPrefix]) -> str:
-    """Calcula o status automaticamente baseado na marcação 'usado' e filhos"""
-    # Se está marcado como usado, retorna "usado"
-    if prefix.usado:
-        return "usado"
-    
-    # Verificar todos os filhos (incluindo auto-criados)
-    children = [p for p in all_prefixes if p.parent_id == prefix.id]
-    
-    # Se não tem filhos, está livre
-    if not children:
-        return "livre"
-    
-    # Verificar status de todos os filhos
-    children_status = []
-    user_created_children_status = []
-    
-    for child in children:
-        child_status = calculate_status(child, all_prefixes)
-        children_status.append(child_status)
-        
-        # Se é um filho criado pelo usuário, adicionar à lista especial
-        if not child.is_auto_created:
-            user_created_children_status.append(child_status)
-    
-    # Usar todos os filhos (incluindo calculados) para determinar o status final
-    # Se TODOS os filhos estão usados, pai fica usado
-    if all(status == "usado" for status in children_status):
-        return "usado"
-    
-    # Se algum filho está usado ou parcialmente usado, pai fica parcialmente usado
-    if any(status in ["usado", "parcialmente_usado"] for status in children_status):
-        return "parcialmente_usado"
+    Divisões com mais de DIVIDE_SYNC_LIMIT sub-redes rodam em background:
+    a resposta é 202 com o job, acompanhado em GET /jobs/{id}. Mais de
+    MAX_DIVIDE_SUBNETS sub-redes (contando count, se informado) é recusado com 400.
+    """
+    prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
+    if not prefix:
+        raise HTTPException(status_code=404, detail="Prefix not found")
     
-    return "livre"
-
-def build_subnet_tree(prefix: IPPrefix, real_prefixes: dict, all_prefixes: List[IPPrefix]) -> SubnetResponse:
-    """Constrói árvore de sub-redes para um prefixo"""
     try:
         network = ipaddress.ip_network(prefix.prefix)
-        
-        # Calcular estatísticas
-        total_addresses = int(network.num_addresses)
-        used_addresses = calculate_used_addresses(prefix, all_prefixes)
-        available_addresses = total_addresses - used_addresses
-        utilization_percent = round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0
-        
-        # Calcular status automaticamente após gerar filhos
-        # Será calculado depois de gerar os filhos para considerar sub-redes calculadas
-        
-        # Gerar sub-redes automáticas primeiro
-        children = generate_automatic_subnets(network, prefix, real_prefixes, all_prefixes)
-        
-        # Calcular status baseado nos filhos (incluindo calculados)
-        status = calculate_status_from_children(prefix, children)
-        
-        subnet = SubnetResponse(
-            prefix=prefix.prefix,
-            description=prefix.description,
-            status=status,
-            usado=prefix.usado,
-            is_real=True,
-            id=prefix.id,
-            parent_id=prefix.parent_id,
-            total_addresses=total_addresses,
-            used_addresses=used_addresses,
-            available_addresses=available_addresses,
-            utilization_percent=utilization_percent,
-            children=children
-        )
-        
-        return subnet
-        
-    except ValueError:
-        return SubnetResponse(
-            prefix=prefix.prefix,
-            description=prefix.description,
-            status="erro",
-            usado=prefix.usado,
-            is_real=True,
-            id=prefix.id,
-            parent_id=prefix.parent_id,
-            total_addresses=0,
-            used_addresses=0,
-            available_addresses=0,
-            utilization_percent=0,
-            children=[]
-        )
-
-def generate_automatic_subnets(parent_network: ipaddress.IPv4Network | ipaddress.IPv6Network, 
-                             parent_prefix: IPPrefix, 
-                             real_prefixes: dict, 
-                             all_prefixes: List[IPPrefix]) -> List[SubnetResponse]:
-    """Gera sub-redes automáticas apenas se existir relacionamento pai/filho"""
-    children = []
-    
-    # Buscar filhos reais e ordená-los numericamente
-    real_children = [p for p in all_prefixes if p.parent_id == parent_prefix.id]
-    real_children.sort(key=lambda p: ipaddress.ip_network(p.prefix).network_address)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {str(e)}")
     
-    # Verificar se há prefixos filhos relacionados (diretos ou indiretos)
-    has_related_children = False
+    current_mask = network.prefixlen
+    max_mask = 32 if network.version == 4 else 128
     
-    # Verificar filhos diretos
-    if real_children:
-        has_related_children = True
+    # Determinar a máscara alvo
+    if request.target_mask is not None:
+        target_mask = request.target_mask
+        if target_mask <= current_mask or target_mask > max_mask:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Target mask must be between {current_mask + 1} and {max_mask}"
+            )
     else:
-        # Verificar se há prefixos que estariam contidos neste parent
-        for prefix in all_prefixes:
-            if prefix.id != parent_prefix.id:
-                try:
-                    prefix_network = ipaddress.ip_network(prefix.prefix)
-                    # Se o prefix está contido no parent (seria filho)
-                    if prefix_network.subnet_of(parent_network):
-                        has_related_children = True
-                        break
-                except ValueError:
-                    continue
-    
-    # Só gerar subredes calculadas se houver relacionamento
-    if not has_related_children:
-        return children
-    
-    # Sequência de prefixos decrescente: /32,/31,/30,/29,/28,/27,/26,/25,/24,/23,/22,/21,/20,/19,/18,/17,/16,/15,/14,/13,/12,/11,/10,/9,/8,/7,/6,/5,/4,/3,/2,/1,/0
-    prefix_sequence = list(range(32, -1, -1)) if parent_network.version == 4 else list(range(128, -1, -1))
-    
-    # Encontrar o próximo prefixo na sequência com maior máscara possível
-    # Para máxima granularidade, sempre usar incremento de 1 bit
-    current_prefix = parent_network.prefixlen
-    target_prefix = current_prefix + 1
-    
-    # Verificar se o target_prefix está na sequência válida
-    max_prefix = 32 if parent_network.version == 4 else 128
-    if target_prefix > max_prefix:
-        target_prefix = None
-    
-    # Primeiro, adicionar TODOS os filhos reais
-    for real_child in real_children:
-        child_tree = build_subnet_tree(real_child, real_prefixes, all_prefixes)
-        children.append(child_tree)
-    
-    # Se encontrou um target prefix válido e pode ser dividido, adicionar sub-redes calculadas
-    if target_prefix is not None:
-        try:
-            # Gerar todas as sub-redes do próximo tamanho na sequência
-            subnets = list(parent_network.subnets(new_prefix=target_prefix))
-            
-            for i, subnet in enumerate(subnets):
-                subnet_str = str(subnet)
-                
-                # Pular se já existe um prefixo real exatamente nesta sub-rede
-                if any(p.prefix == subnet_str for p in real_children):
-                    continue
-                
-                # Verificar se esta sub-rede tem prefixos reais dentro dela
-                used_addresses = calculate_used_addresses_in_subnet(subnet, all_prefixes)
-                total_addresses = int(subnet.num_addresses)
-                available_addresses = total_addresses - used_addresses
-                utilization_percent = round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0
-                
-                # Determinar status
-                if used_addresses == 0:
-                    status = "livre"
-                elif used_addresses == total_addresses:
-                    status = "usado"
-                else:
-                    status = "parcialmente_usado"
-                
-                child_subnet = SubnetResponse(
-                    prefix=subnet_str,
-                    description=f"Sub-rede {i+1} de {parent_network}",
-                    status=status,
-                    usado=False,  # Sub-redes calculadas não são marcadas como usadas
-                    is_real=False,  # Sub-rede calculada
-                    id=None,
-                    parent_id=parent_prefix.id,
-                    total_addresses=total_addresses,
-                    used_addresses=used_addresses,
-                    available_addresses=available_addresses,
-                    utilization_percent=utilization_percent,
-                    children=[]
-                )
-                
-                # Recursivamente gerar sub-redes se necessário
-                if status == "parcialmente_usado" and subnet.prefixlen < max_prefix:
-                    child_subnet.children = generate_automatic_subnets_calculated(subnet, parent_prefix.id, all_prefixes)
-                
-                children.append(child_subnet)
-                
-        except ValueError:
-            pass
-    
-    # Ordenar todos os children por endereço IP
-    children.sort(key=lambda c: ipaddress.ip_network(c.prefix).network_address)
-    
-    return children
-
-def generate_automatic_subnets_calculated(network: ipaddress.IPv4Network | ipaddress.IPv6Network,
-                                        parent_id: int,
-                                        all_prefixes: List[IPPrefix]) -> List[SubnetResponse]:
-    """Gera sub-redes para redes calculadas (não reais)"""
-    children = []
-    max_prefix = 30 if network.version == 4 else 126
+        # Usar a máscara mais específica possível (incremento de 1)
+        target_mask = current_mask + 1
+        if target_mask > max_mask:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Cannot divide further - already at maximum mask /{max_mask}"
+            )
     
-    if network.prefixlen < max_prefix:
-        try:
-            subnets = list(network.subnets(new_prefix=network.prefixlen + 1))
-            
-            for i, subnet in enumerate(subnets):
-                subnet_str = str(subnet)
-                
-                used_addresses = calculate_used_addresses_in_subnet(subnet, all_prefixes)
-                total_addresses = int(subnet.num_addresses)
-                available_addresses = total_addresses - used_addresses
-                utilization_percent = round((used_addresses / total_addresses) * 100, 2) if total_addresses > 0 else 0
-                
-                if used_addresses == 0:
-                    status = "livre"
-                elif used_addresses == total_addresses:
-                    status = "usado"
-                else:
-                    status = "parcialmente_usado"
-                
-                child_subnet = SubnetResponse(
-                    prefix=subnet_str,
-                    description=f"Sub-rede {i+1} de {network}",
-                    status=status,
-                    usado=False,  # Sub-redes calculadas não são marcadas como usadas
-                    is_real=False,
-                    id=None,
-                    parent_id=parent_id,
-                    total_addresses=total_addresses,
-                    used_addresses=used_addresses,
-                    available_addresses=available_addresses,
-                    utilization_percent=utilization_percent,
-                    children=[]
-                )
-                
-                if status == "parcialmente_usado" and subnet.prefixlen < max_prefix:
-                    child_subnet.children = generate_automatic_subnets_calculated(subnet, parent_id, all_prefixes)
-                
-                children.append(child_subnet)
-                
-        except ValueError:
-            pass
-    
-    # Ordenar todos os children por endereço IP
-    children.sort(key=lambda c: ipaddress.ip_network(c.prefix).network_address)
+    # Limitar número de sub-redes se especificado
+    subnet_count = 2 ** (target_mask - current_mask)
+    if request.count is not None:
+        if request.count <= 0 or request.count > subnet_count:
+            raise HTTPException(
+                status_code=400, 
+                detail=f"Count must be between 1 and {subnet_count}"
+            )
+        subnet_count = request.count
     
-    return children
-
-def calculate_used_addresses(prefix: IPPrefix, all_prefixes: List[IPPrefix]) -> int:
-    """Calcula endereços usados pelos filhos diretos considerando uso recursivo"""
-    used = 0
+    if subnet_count > MAX_DIVIDE_SUBNETS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Division would create {subnet_count} subnets; the maximum is {MAX_DIVIDE_SUBNETS} (use count to limit it)"
+        )
     
-    # Buscar apenas filhos diretos
-    direct_children = [p for p in all_prefixes if p.parent_id == prefix.id]
+    if subnet_count > DIVIDE_SYNC_LIMIT:
+        job = job_runner.submit(
+            "divide", divide_job(prefix_id, target_mask, request.count, current_user.id), total=subnet_count
+        )
+        return JSONResponse(status_code=202, content=job.model_dump(mode="json"))
     
-    for child in direct_children:
-        try:
-            child_network = ipaddress.ip_network(child.prefix)
-            child_total = int(child_network.num_addresses)
-            
-            if child.usado:
-                # Se o filho está marcado como usado, conta todos os seus endereços
-                used += child_total
-            else:
-                # Se não está marcado como usado, conta apenas o que ele tem de usado recursivamente
-                child_used = calculate_used_addresses(child, all_prefixes)
-                used += child_used
-        except ValueError:
-            continue
+    try:
+        total = divide_prefix_subnets(db, prefix, target_mask, request.count, current_user.id)
+        bump_data_version(db)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error dividing prefix: {str(e)}")
     
-    return used
-
-def calculate_used_addresses_in_subnet(subnet: ipaddress.IPv4Network | ipaddress.IPv6Network, 
-                                     all_prefixes: List[IPPrefix]) -> int:
-    """Calcula endereços usados dentro de uma sub-rede calculada pelos filhos diretos marcados como 'usado'"""
-    used = 0
-    
-    # Buscar apenas prefixos que são filhos diretos desta sub-rede
-    for prefix in all_prefixes:
-        try:
-            if prefix.usado:
-                prefix_network = ipaddress.ip_network(prefix.prefix)
-                # Verificar se é filho direto (está contido e não há intermediários)
-                if prefix_network.subnet_of(subnet):
-                    # Verificar se não há prefixos intermediários
-                    is_direct_child = True
-                    for other in all_prefixes:
-                        if other.id != prefix.id:
-                            try:
-                                other_network = ipaddress.ip_network(other.prefix)
-                                # Se há um prefixo entre a subnet e este prefix
-                                if (prefix_network.subnet_of(other_network) and 
-                                    other_network.subnet_of(subnet) and 
-                                    other_network != subnet):
-                                    is_direct_child = False
-                                    break
-                            except ValueError:
-                                continue
-                    
-                    if is_direct_child:
-                        used += int(prefix_network.num_addresses)
-        except ValueError:
-            continue
+    return DivideResponse(
+        subnets=subnet_range_query(db, network, target_mask, request.count).all(),
+        message=f"Created {total} subnets with /{target_mask} mask"
+    )
+
+@app.post("/lookup", response_model=LookupResponse)
+def lookup_addresses(request: LookupRequest, current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Prefixo cadastrado mais específico de cada endereço (longest prefix match em lote).
+
+    Endereços inválidos voltam com "error"; endereços fora de qualquer prefixo, com prefix null.
+    """
+    if len(request.addresses) > MAX_LOOKUP_ADDRESSES:
+        raise HTTPException(status_code=400, detail=f"Too many addresses (max {MAX_LOOKUP_ADDRESSES})")
     
-    return used
+    # Resposta montada direto em JSON: validar centenas de milhares de itens custaria mais que a busca
+    return FastJSONResponse(content={"results": lookup_index.lookup(db, request.addresses)})
 
-@app.post("/prefixes/{prefix_id}/divide", response_model=DivideResponse)
-async def divide_prefix(prefix_id: int, request: DivideRequest, current_user: User = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
-    """Divide um prefixo em sub-redes com a maior máscara possível"""
+MAX_ALLOCATE_COUNT = 1024
+ALLOCATE_STRATEGIES = ("first", "best")
+
+@app.post("/prefixes/{prefix_id}/allocate", response_model=AllocateResponse)
+def allocate_prefixes(prefix_id: int, request: AllocateRequest, current_user: Principal = Depends(require_operador_or_admin), db: Session = Depends(get_db)):
+    """Reserva count blocos livres /prefixlen dentro do prefixo (first-fit ou best-fit)"""
     prefix = db.query(IPPrefix).filter(IPPrefix.id == prefix_id).first()
     if not prefix:
         raise HTTPException(status_code=404, detail="Prefix not found")
+    if prefix.prefixlen is None:
+        raise HTTPException(status_code=400, detail="Invalid IP prefix")
+    
+    max_mask = 128 if prefix.is_ipv6 else 32
+    if request.prefixlen <= prefix.prefixlen or request.prefixlen > max_mask:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Prefix length must be between {prefix.prefixlen + 1} and {max_mask}"
+        )
+    if request.count < 1 or request.count > MAX_ALLOCATE_COUNT:
+        raise HTTPException(status_code=400, detail=f"Count must be between 1 and {MAX_ALLOCATE_COUNT}")
+    if request.strategy not in ALLOCATE_STRATEGIES:
+        raise HTTPException(status_code=400, detail=f"Strategy must be one of {list(ALLOCATE_STRATEGIES)}")
+    
+    network_class = ipaddress.IPv6Network if prefix.is_ipv6 else ipaddress.IPv4Network
     
+    write_locks.lock_parent(db, prefix.id, 6 if prefix.is_ipv6 else 4)
+    starts = free_space_index.allocate(db, prefix, request.prefixlen, request.count, request.strategy)
+    if starts is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Not enough free space for {request.count} /{request.prefixlen} block(s) in {prefix.prefix}"
+        )
+    
+    allocated = []
     try:
-        network = ipaddress.ip_network(prefix.prefix)
-        current_mask = network.prefixlen
-        max_mask = 32 if network.version == 4 else 128
-        
-        # Determinar a máscara alvo
-        if request.target_mask is not None:
-            target_mask = request.target_mask
-            if target_mask <= current_mask or target_mask > max_mask:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Target mask must be between {current_mask + 1} and {max_mask}"
-                )
-        else:
-            # Usar a máscara mais específica possível (incremento de 1)
-            target_mask = current_mask + 1
-            if target_mask > max_mask:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Cannot divide further - already at maximum mask /{max_mask}"
-                )
-        
-        # Gerar sub-redes
-        subnets = list(network.subnets(new_prefix=target_mask))
-        
-        # Limitar número de sub-redes se especificado
-        if request.count is not None:
-            if request.count <= 0 or request.count > len(subnets):
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"Count must be between 1 and {len(subnets)}"
-                )
-            subnets = subnets[:request.count]
-        
-        # Criar prefixos no banco
-        created_prefixes = []
-        for i, subnet in enumerate(subnets):
-            subnet_str = str(subnet)
-            
-            # Verificar se já existe
-            existing = db.query(IPPrefix).filter(IPPrefix.prefix == subnet_str).first()
-            if existing:
-                created_prefixes.append(existing)
-                continue
-            
-            # Criar novo prefixo
-            new_prefix = IPPrefix(
-                prefix=subnet_str,
-                description=f"Sub-rede {i+1} de {prefix.prefix}",
-                usado=False,
-                is_auto_created=True,
-                parent_id=prefix_id,
-                is_ipv6=network.version == 6
-            )
-            
-            db.add(new_prefix)
-            created_prefixes.append(new_prefix)
-        
+        for start in starts:
+            network = network_class((start, request.prefixlen))
+            allocated.append(IPPrefix(
+                prefix=str(network),
+                description=request.description or f"Alocado de {prefix.prefix}",
+                usado=request.usado,
+                is_auto_created=False,
+                parent_id=prefix.id,
+                is_ipv6=prefix.is_ipv6,
+                user_id=current_user.id
+            ))
+        db.add_all(allocated)
+        refresh_rollups(db, [prefix.id])
+        bump_data_version(db)
         db.commit()
-        
-        # Refresh all objects to get IDs
-        for p in created_prefixes:
-            if p.id is None:
-                db.refresh(p)
-        
-        return DivideResponse(
-            subnets=created_prefixes,
-            message=f"Created {len(created_prefixes)} subnets with /{target_mask} mask"
-        )
-        
-    except ValueError as e:
-        raise HTTPException(status_code=400, detail=f"Invalid IP prefix: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error dividing prefix: {str(e)}")
+    except IntegrityError:
+        db.rollback()
+        free_space_index.invalidate(prefix.id)
+        raise HTTPException(status_code=409, detail="Allocation conflict, please retry")
+    except Exception:
+        db.rollback()
+        free_space_index.invalidate(prefix.id)
+        raise
+    
+    for allocated_prefix in allocated:
+        db.refresh(allocated_prefix)
+    
+    return AllocateResponse(
+        prefixes=allocated,
+        message=f"Allocated {len(allocated)} /{request.prefixlen} block(s) in {prefix.prefix}"
+    )
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+def get_job(job_id: str, current_user: Principal = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Estado e progresso de um job em background (de qualquer worker)"""
+    job = job_runner.get(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_response(job)
+
+@app.get("/health/pool")
+async def get_pool_status(current_user: Principal = Depends(require_admin)):
+    """Estado do pool de conexões e contadores de espera/overflow (apenas ADMIN)"""
+    return pool_status(engine)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Métricas no formato texto do Prometheus"""
+    pool = pool_status(engine)
+    gauges = {
+        f"ipam_db_pool_{name}": pool[name]
+        for name in ("size", "max_overflow", "checked_out", "checked_in", "overflow") if name in pool
+    }
+    counters = {
+        f"ipam_db_pool_{name}_total": pool[name]
+        for name in ("checkouts", "overflow_checkouts", "timeouts") if name in pool
+    }
+    if "wait_seconds_total" in pool:
+        counters["ipam_db_pool_wait_seconds_total"] = pool["wait_seconds_total"]
+    return PlainTextResponse(
+        metrics_registry.render(gauges, counters), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 def create_default_admin_if_needed():
     """Cria usuário admin padrão se não existir nenhum admin"""
@@ -0,0 +1,176 @@
+"""
+Métricas de requisições e do banco no formato texto do Prometheus (GET /metrics).
+
+O middleware registra, por rota (o template, ex: /prefixes/{prefix_id}), a
+contagem de requisições, histogramas de latência e de tamanho da resposta e
+quantas consultas SQL cada requisição fez (eventos do cursor do SQLAlchemy).
+Cada resposta leva também um header Server-Timing com o tempo do app e do banco.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000, 10_000)
+
+
+class RequestStats:
+    """Consultas e tempo de banco de uma requisição (compartilhado com as threads do threadpool)"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Último = +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[tuple, int] = defaultdict(int)  # (método, rota, status)
+        self.latency: Dict[tuple, Histogram] = {}  # (método, rota)
+        self.size: Dict[tuple, Histogram] = {}
+        self.queries: Dict[tuple, Histogram] = {}
+        self.db_seconds: Dict[tuple, float] = defaultdict(float)
+
+    def record(self, method: str, route: str, status: int, seconds: float, size: int, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self.requests[(method, route, status)] += 1
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.size.setdefault(key, Histogram(SIZE_BUCKETS)).observe(size)
+            self.queries.setdefault(key, Histogram(QUERY_BUCKETS)).observe(stats.queries)
+            self.db_seconds[key] += stats.db_seconds
+
+    def render(self, gauges: Optional[Dict[str, float]] = None, counters: Optional[Dict[str, float]] = None) -> str:
+        """Exposição no formato texto do Prometheus (version 0.0.4)"""
+        lines = []
+        with self._lock:
+            lines += [
+                "# HELP ipam_http_requests_total Requisições HTTP por rota e status.",
+                "# TYPE ipam_http_requests_total counter",
+            ]
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f'ipam_http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+            for name, help_text, histograms in (
+                ("ipam_http_request_duration_seconds", "Latência das requisições HTTP.", self.latency),
+                ("ipam_http_response_size_bytes", "Tamanho do corpo das respostas HTTP.", self.size),
+                ("ipam_db_queries_per_request", "Consultas SQL executadas por requisição.", self.queries),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for (method, route), histogram in sorted(histograms.items()):
+                    labels = f'method="{method}",route="{route}"'
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.sum:g}")
+                    lines.append(f"{name}_count{{{labels}}} {cumulative}")
+
+            lines += [
+                "# HELP ipam_db_query_seconds_total Tempo gasto em consultas SQL por rota.",
+                "# TYPE ipam_db_query_seconds_total counter",
+            ]
+            for (method, route), seconds in sorted(self.db_seconds.items()):
+                lines.append(f'ipam_db_query_seconds_total{{method="{method}",route="{route}"}} {seconds:g}')
+
+        for metric_type, values in (("gauge", gauges), ("counter", counters)):
+            for name, value in sorted((values or {}).items()):
+                lines += [f"# TYPE {name} {metric_type}", f"{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics_registry = MetricsRegistry()
+_watched_engines = set()
+
+
+def watch_engine(engine):
+    """Conta as consultas e o tempo de banco da requisição corrente"""
+    if id(engine) in _watched_engines:
+        return
+    _watched_engines.add(id(engine))
+
+    # O início fica no contexto de execução do comando, descartado com ele, e
+    # não na conexão: comandos que falham não deixam nada acumulado no pool
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    def record_query(context):
+        started = getattr(context, "query_started", None)
+        stats = current_request.get()
+        if started is not None and stats is not None:
+            stats.queries += 1
+            stats.db_seconds += time.perf_counter() - started
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record_query(context)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        # Comandos que falham (ex: IntegrityError, "database is locked") também contam
+        record_query(exception_context.execution_context)
+
+
+class MetricsMiddleware:
+    """Middleware ASGI que alimenta o metrics_registry e adiciona o header Server-Timing"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        response = {"status": 500, "size": 0}
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                app_ms = (time.perf_counter() - started) * 1000
+                timing = f'app;dur={app_ms:.1f}, db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"'
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_request.reset(token)
+            # Template da rota (FastAPI) para não criar uma série por id
+            route = scope.get("route")
+            metrics_registry.record(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                response["status"],
+                time.perf_counter() - started,
+                response["size"],
+                stats
+            )
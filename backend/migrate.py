@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Migrações incrementais do schema
+Uso: python migrate.py [--repair-tree]
+
+Executado também no startup (init_db). Cada passo é idempotente: adiciona
+colunas/índices ausentes em bancos criados por versões anteriores e faz o
+backfill das linhas existentes. --repair-tree refaz o parent_id de bancos
+com árvores de antes da manutenção incremental (com o backend parado).
+"""
+
+import ipaddress
+import sys
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.types import SchemaType
+from models import Base, DataVersion, IPPrefix, network_columns
+from reparent import repair_parent_ids
+from rollup import rebuild_all_rollups
+from versioned_cache import bump_data_version
+
+BACKFILL_BATCH_SIZE = 1000
+
+def add_missing_columns(engine: Engine, table) -> list:
+    """Adiciona ao banco as colunas do modelo que ainda não existem na tabela"""
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    added = []
+
+    with engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if isinstance(column.type, SchemaType):
+                # Ex: ENUM nativo do PostgreSQL precisa existir antes da coluna
+                column.type.create(bind=conn, checkfirst=True)
+            column_type = column.type.compile(dialect=engine.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+            conn.execute(text(ddl))
+            added.append(column.name)
+
+    return added
+
+def create_missing_indexes(engine: Engine, table):
+    """Cria os índices declarados no modelo que ainda não existem"""
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+def backfill_network_columns(engine: Engine) -> int:
+    """Preenche network_start/network_end/prefixlen/cidr das linhas antigas"""
+    table = IPPrefix.__table__
+    updated = 0
+
+    with engine.begin() as conn:
+        rows = conn.execute(
+            table.select().with_only_columns(table.c.id, table.c.prefix).where(table.c.prefixlen.is_(None))
+        ).fetchall()
+
+        batch = []
+        for row in rows:
+            try:
+                network = ipaddress.ip_network(row.prefix, strict=False)
+            except ValueError:
+                continue
+            batch.append({"row_id": row.id, **network_columns(network)})
+
+            if len(batch) >= BACKFILL_BATCH_SIZE:
+                updated += _update_network_columns(conn, batch)
+                batch = []
+
+        if batch:
+            updated += _update_network_columns(conn, batch)
+
+    return updated
+
+def _update_network_columns(conn, batch: list) -> int:
+    table = IPPrefix.__table__
+    conn.execute(
+        table.update().where(table.c.id == bindparam("row_id")).values(
+            network_start=bindparam("network_start"),
+            network_end=bindparam("network_end"),
+            prefixlen=bindparam("prefixlen"),
+            cidr=bindparam("cidr"),
+        ),
+        batch
+    )
+    return len(batch)
+
+def ensure_data_version_row(engine: Engine):
+    """Cria a linha única de versão dos dados, se ainda não existir"""
+    table = DataVersion.__table__
+    with engine.begin() as conn:
+        if conn.execute(table.select().where(table.c.id == 1)).first() is None:
+            conn.execute(table.insert().values(id=1, version=0))
+
+def run_migrations(engine: Engine):
+    """Aplica todas as migrações pendentes"""
+    table = IPPrefix.__table__
+    added = add_missing_columns(engine, table)
+    create_missing_indexes(engine, table)
+    backfilled = backfill_network_columns(engine)
+    ensure_data_version_row(engine)
+
+    if "status" in added:
+        with Session(bind=engine) as db:
+            backfilled += rebuild_all_rollups(db)
+            db.commit()
+
+    if added or backfilled:
+        print(f"🔧 Migração ip_prefixes: colunas adicionadas {added}, linhas preenchidas: {backfilled}")
+
+def repair_tree(engine: Engine):
+    """Refaz parent_id pela contenção de endereços e recalcula os rollups (árvores antigas)"""
+    with Session(bind=engine) as db:
+        repaired = repair_parent_ids(db)
+        if repaired:
+            rebuild_all_rollups(db)
+            # Caches dos processos em execução (resultados, espaço livre) passam a ser refeitos
+            bump_data_version(db)
+        db.commit()
+    print(f"🌳 Árvore de prefixos: {repaired} parent_id corrigidos")
+
+if __name__ == "__main__":
+    from database import engine
+
+    print("🚀 Aplicando migrações...")
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    if "--repair-tree" in sys.argv:
+        repair_tree(engine)
+    print("✅ Migrações concluídas")
@@ -1,12 +1,55 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Enum
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Enum, Index, Numeric, JSON
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
+from sqlalchemy.types import TypeDecorator
 from datetime import datetime
 import hashlib
+import ipaddress
 import enum
 
 Base = declarative_base()
 
+class IPInteger(TypeDecorator):
+    """Inteiro de até 128 bits: NUMERIC(39) no PostgreSQL, texto com zeros à esquerda nos demais.
+
+    O preenchimento com zeros mantém a ordenação e as comparações de faixa
+    corretas mesmo em bancos sem inteiros de 128 bits (ex: SQLite).
+    """
+    impl = String(39)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(Numeric(39, 0))
+        return dialect.type_descriptor(String(39))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if dialect.name == "postgresql":
+            return int(value)
+        return f"{int(value):039d}"
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return int(value)
+
+def network_columns(network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> dict:
+    """Colunas numéricas derivadas de um prefixo (para inserções em lote)"""
+    return {
+        "network_start": int(network.network_address),
+        "network_end": int(network.broadcast_address),
+        "prefixlen": network.prefixlen,
+        "cidr": str(network),
+    }
+
+class PrefixStatus(enum.Enum):
+    LIVRE = "livre"
+    USADO = "usado"
+    PARCIALMENTE_USADO = "parcialmente_usado"
+
 class UserRole(enum.Enum):
     VISUALIZADOR = "visualizador"
     OPERADOR = "operador"
@@ -63,15 +106,76 @@ class IPPrefix(Base):
     description = Column(String, nullable=False)
     usado = Column(Boolean, default=False, nullable=False)  # True se marcado como usado
     is_auto_created = Column(Boolean, default=False, nullable=False)  # True se criado automaticamente como intermediário
-    parent_id = Column(Integer, ForeignKey("ip_prefixes.id"), nullable=True)
+    parent_id = Column(Integer, ForeignKey("ip_prefixes.id"), nullable=True, index=True)
     is_ipv6 = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     
+    # Faixa numérica do prefixo para consultas de contenção indexadas
+    network_start = Column(IPInteger, nullable=True)
+    network_end = Column(IPInteger, nullable=True)
+    prefixlen = Column(Integer, nullable=True)
+    cidr = Column(String().with_variant(postgresql.CIDR(), "postgresql"), nullable=True)
+    
+    # Rollups de utilização mantidos incrementalmente ao longo dos ancestrais
+    used_addresses = Column(IPInteger, default=0, nullable=True)  # Mesma regra da hierarquia
+    child_count = Column(Integer, default=0, server_default="0", nullable=False)
+    child_addresses = Column(IPInteger, default=0, nullable=True)  # Soma dos tamanhos dos filhos diretos
+    status = Column(Enum(PrefixStatus), default=PrefixStatus.LIVRE, nullable=True)
+    
+    __table_args__ = (
+        Index("ix_ip_prefixes_range", "is_ipv6", "network_start", "network_end"),
+        # Ordem de endereço da paginação por keyset de GET /prefixes
+        Index("ix_ip_prefixes_address_order", "is_ipv6", "network_start", "prefixlen", "id"),
+        Index(
+            "ix_ip_prefixes_cidr_gist", "cidr",
+            postgresql_using="gist", postgresql_ops={"cidr": "inet_ops"}
+        ).ddl_if(dialect="postgresql"),
+    )
+    
     # Relacionamentos
     parent = relationship("IPPrefix", remote_side=[id], backref="children")
     owner = relationship("User", back_populates="prefixes")
     
+    @validates("prefix")
+    def _sync_network_columns(self, key, value):
+        """Mantém as colunas numéricas coerentes com o texto do prefixo"""
+        try:
+            network = ipaddress.ip_network(value, strict=False)
+        except ValueError:
+            return value
+        for column, column_value in network_columns(network).items():
+            setattr(self, column, column_value)
+        return value
+    
+    def __repr__(self):
+        return f"<IPPrefix(id={self.id}, prefix='{self.prefix}', description='{self.description}')>"
+
+class DataVersion(Base):
+    """Versão global dos dados de prefixos, incrementada a cada alteração"""
+    __tablename__ = "data_version"
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f"<DataVersion(version={self.version})>"
+
+class BackgroundJob(Base):
+    """Estado dos jobs em background (ver jobs.py), visível para todos os workers"""
+    __tablename__ = "jobs"
+    
+    id = Column(String(32), primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default="queued")  # queued, running, done, failed
+    processed = Column(Integer, nullable=False, default=0)
+    total = Column(Integer, nullable=True)
+    result = Column(JSON, nullable=True)
+    error = Column(String, nullable=True)
+    worker = Column(String, nullable=True)  # host:pid do processo que executa o job
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    
     def __repr__(self):
-        return f"<IPPrefix(id={self.id}, prefix='{self.prefix}', description='{self.description}')>"
\ No newline at end of file
+        return f"<BackgroundJob(id='{self.id}', kind='{self.kind}', status='{self.status}')>"
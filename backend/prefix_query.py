@@ -0,0 +1,121 @@
+"""
+Consulta de GET /prefixes com filtros, colunas escolhidas e paginação por keyset.
+
+A paginação segue a ordem de endereço (família, início da rede, máscara, id),
+coberta pelo índice ix_ip_prefixes_address_order: cada página continua de
+onde a anterior parou (WHERE chave > cursor) em vez de pular linhas com OFFSET.
+
+A faixa numérica de cada prefixo funciona como um caminho materializado da
+árvore: a subárvore é uma consulta de faixa e os ancestrais são as super-redes,
+buscadas de uma vez no índice único de prefix, qualquer que seja a profundidade.
+"""
+
+import base64
+import ipaddress
+import json
+from typing import List, Optional, Sequence
+from sqlalchemy import literal, tuple_
+from sqlalchemy.orm import Session
+from models import IPPrefix
+from schemas import IPPrefixResponse
+
+PREFIX_FIELDS = tuple(IPPrefixResponse.model_fields)
+ORDER_COLUMNS = (IPPrefix.is_ipv6, IPPrefix.network_start, IPPrefix.prefixlen, IPPrefix.id)
+
+
+def parse_fields(fields: Optional[str]) -> Sequence[str]:
+    """Lista fields=prefix,description validada contra os campos de IPPrefixResponse"""
+    if not fields:
+        return PREFIX_FIELDS
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in PREFIX_FIELDS]
+    if unknown or not requested:
+        raise ValueError(f"Unknown fields {unknown}; available: {', '.join(PREFIX_FIELDS)}")
+    return list(dict.fromkeys(requested))
+
+
+def filter_conditions(family: Optional[int] = None, usado: Optional[bool] = None,
+                      is_auto_created: Optional[bool] = None, user_id: Optional[int] = None,
+                      parent_id: Optional[int] = None, within: Optional[str] = None) -> list:
+    """Condições SQL dos filtros informados (within = contido no CIDR, inclusive)"""
+    conditions = []
+    if family is not None:
+        conditions.append(IPPrefix.is_ipv6 == (family == 6))
+    if usado is not None:
+        conditions.append(IPPrefix.usado == usado)
+    if is_auto_created is not None:
+        conditions.append(IPPrefix.is_auto_created == is_auto_created)
+    if user_id is not None:
+        conditions.append(IPPrefix.user_id == user_id)
+    if parent_id is not None:
+        conditions.append(IPPrefix.parent_id == parent_id)
+    if within is not None:
+        network = ipaddress.ip_network(within, strict=False)
+        conditions += [
+            IPPrefix.is_ipv6 == (network.version == 6),
+            IPPrefix.network_start >= int(network.network_address),
+            IPPrefix.network_end <= int(network.broadcast_address),
+            IPPrefix.prefixlen >= network.prefixlen,
+        ]
+    return conditions
+
+
+def subtree_conditions(prefix: IPPrefix) -> list:
+    """Descendentes de prefix em qualquer nível (contidos na faixa dele, exceto ele próprio)"""
+    return [
+        IPPrefix.is_ipv6 == prefix.is_ipv6,
+        IPPrefix.network_start.between(prefix.network_start, prefix.network_end),
+        IPPrefix.network_end <= prefix.network_end,
+        IPPrefix.prefixlen > prefix.prefixlen,
+    ]
+
+
+def ancestors_query(db: Session, fields: Sequence[str], network: ipaddress.IPv4Network | ipaddress.IPv6Network):
+    """Prefixos que contêm network, do root ao pai imediato (no máximo 32/128 super-redes)"""
+    supernets = [str(network.supernet(new_prefix=prefixlen)) for prefixlen in range(network.prefixlen)]
+    return db.query(*[getattr(IPPrefix, field) for field in fields]).filter(
+        IPPrefix.prefix.in_(supernets)
+    ).order_by(IPPrefix.prefixlen)
+
+
+def encode_cursor(row) -> str:
+    """Cursor opaco com a chave de ordenação da última linha da página"""
+    key = [row.is_ipv6, str(row.network_start), row.prefixlen, row.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        is_ipv6, network_start, prefixlen, prefix_id = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+        return bool(is_ipv6), int(network_start), int(prefixlen), int(prefix_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def prefixes_query(db: Session, fields: Sequence[str], conditions: list, cursor: Optional[str] = None):
+    """Colunas pedidas (mais a chave de ordenação) em ordem de endereço, a partir do cursor"""
+    columns = [getattr(IPPrefix, field) for field in fields]
+    columns += [column for column in ORDER_COLUMNS if column.key not in fields]
+    query = db.query(*columns).filter(IPPrefix.prefixlen.isnot(None), *conditions)
+    if cursor:
+        # Valores com o tipo de cada coluna (ex: network_start como texto no SQLite)
+        key = [literal(value, column.type) for column, value in zip(ORDER_COLUMNS, decode_cursor(cursor))]
+        query = query.filter(tuple_(*ORDER_COLUMNS) > tuple_(*key))
+    return query.order_by(*ORDER_COLUMNS)
+
+
+def row_to_dict(row, fields: Sequence[str]) -> dict:
+    return {field: getattr(row, field) for field in fields}
+
+
+def fetch_page(db: Session, fields: Sequence[str], conditions: list, limit: Optional[int],
+               cursor: Optional[str] = None) -> tuple:
+    """(itens, próximo cursor ou None) de uma página com até limit linhas"""
+    query = prefixes_query(db, fields, conditions, cursor)
+    if limit is None:
+        return [row_to_dict(row, fields) for row in query], None
+    rows: List = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [row_to_dict(row, fields) for row in rows[:limit]], next_cursor
@@ -0,0 +1,82 @@
+"""
+Manutenção incremental do parent_id quando um prefixo entra ou sai do meio da árvore.
+
+Inserir N entre um pai P e filhos já existentes move, com um único UPDATE de
+faixa, os filhos diretos de P contidos em N para debaixo de N; remover N
+devolve os filhos de N para P da mesma forma. Nenhuma das operações varre a
+tabela: o filtro usa parent_id e o índice de faixa (is_ipv6, network_start,
+network_end). Os rollups ficam a cargo de refresh_rollups em N (ou P), que já
+percorre a cadeia de ancestrais afetada.
+"""
+
+import ipaddress
+from typing import Optional
+from sqlalchemy import bindparam
+from sqlalchemy.orm import Session
+from free_space import free_space_index
+from models import IPPrefix
+
+
+def move_children(db: Session, old_parent_id: Optional[int], new_parent_id: Optional[int], conditions: list) -> int:
+    """UPDATE do parent_id dos filhos diretos de old_parent_id que atendem às condições"""
+    parent_condition = IPPrefix.parent_id.is_(None) if old_parent_id is None else IPPrefix.parent_id == old_parent_id
+    moved = db.query(IPPrefix).filter(parent_condition, *conditions).update(
+        {IPPrefix.parent_id: new_parent_id}, synchronize_session="fetch"
+    )
+    if moved:
+        # Listas livres em cache dos dois pais mudaram fora dos eventos do ORM
+        free_space_index.stage(db, "invalidate", old_parent_id)
+        free_space_index.stage(db, "invalidate", new_parent_id)
+    return moved
+
+
+def adopt_children(db: Session, prefix_id: int, parent_id: Optional[int],
+                   network: ipaddress.IPv4Network | ipaddress.IPv6Network) -> int:
+    """Move para prefix_id os filhos diretos de parent_id contidos em network; retorna quantos"""
+    return move_children(db, parent_id, prefix_id, [
+        IPPrefix.is_ipv6 == (network.version == 6),
+        IPPrefix.network_start.between(int(network.network_address), int(network.broadcast_address)),
+        IPPrefix.network_end <= int(network.broadcast_address),
+        IPPrefix.prefixlen > network.prefixlen,
+        IPPrefix.id != prefix_id,
+    ])
+
+
+def release_children(db: Session, prefix: IPPrefix) -> int:
+    """Devolve os filhos diretos de prefix ao pai dele, antes de removê-lo; retorna quantos"""
+    moved = move_children(db, prefix.id, prefix.parent_id, [])
+    # Sem isso o delete desvincularia (parent_id = NULL) os filhos já carregados na coleção
+    db.expire(prefix, ["children"])
+    return moved
+
+
+def repair_parent_ids(db: Session) -> int:
+    """Refaz o parent_id de todas as linhas pela contenção de endereços; retorna quantas mudaram.
+
+    Para bancos com árvores antigas, de antes da manutenção incremental: uma
+    varredura em ordem de endereço com a pilha dos prefixos abertos dá o pai
+    mais específico de cada linha. Não faz commit nem recalcula os rollups.
+    """
+    rows = db.query(
+        IPPrefix.id, IPPrefix.parent_id, IPPrefix.is_ipv6, IPPrefix.network_start, IPPrefix.network_end
+    ).filter(IPPrefix.prefixlen.isnot(None)).order_by(
+        IPPrefix.is_ipv6, IPPrefix.network_start, IPPrefix.prefixlen
+    ).all()
+
+    changes = []
+    stack = []  # (família, fim, id) dos prefixos abertos
+    for row in rows:
+        while stack and (stack[-1][0] != row.is_ipv6 or stack[-1][1] < row.network_start):
+            stack.pop()
+        parent_id = stack[-1][2] if stack else None
+        if row.parent_id != parent_id:
+            changes.append({"row_id": row.id, "new_parent_id": parent_id})
+        stack.append((row.is_ipv6, row.network_end, row.id))
+
+    if changes:
+        table = IPPrefix.__table__
+        db.connection().execute(
+            table.update().where(table.c.id == bindparam("row_id")).values(parent_id=bindparam("new_parent_id")),
+            changes
+        )
+    return len(changes)
@@ -0,0 +1,150 @@
+"""
+Rollups de utilização persistidos em IPPrefix.
+
+used_addresses, child_count, child_addresses e status de um prefixo dependem
+apenas dos seus filhos diretos, então uma alteração só precisa recalcular o
+próprio prefixo e a cadeia de ancestrais, nível a nível, de baixo para cima.
+"""
+
+import ipaddress
+from collections import defaultdict
+from typing import Dict, Iterable, List
+from sqlalchemy.orm import Session
+from hierarchy import calculate_status_from_children, status_from_usage
+from locks import write_locks
+from models import IPPrefix, PrefixStatus
+
+
+CHILD_COLUMNS = (
+    IPPrefix.id, IPPrefix.parent_id, IPPrefix.prefix, IPPrefix.prefixlen,
+    IPPrefix.network_start, IPPrefix.usado, IPPrefix.used_addresses, IPPrefix.status,
+)
+
+
+def child_range(child, max_prefixlen: int):
+    """(início, tamanho, prefixlen) de um filho, pelas colunas numéricas quando preenchidas"""
+    if child.prefixlen is None or child.network_start is None:
+        network = ipaddress.ip_network(child.prefix)
+        return int(network.network_address), int(network.num_addresses), network.prefixlen
+    return child.network_start, 2 ** (max_prefixlen - child.prefixlen), child.prefixlen
+
+
+def compute_rollup(prefix: IPPrefix, children: List[IPPrefix]) -> dict:
+    """Valores de rollup de um prefixo a partir dos seus filhos diretos"""
+    network = ipaddress.ip_network(prefix.prefix)
+    used_addresses = 0
+    child_addresses = 0
+    children_status = []
+    child_ranges = []
+
+    for child in children:
+        child_start, child_size, child_prefixlen = child_range(child, network.max_prefixlen)
+        child_addresses += child_size
+        used_addresses += child_size if child.usado else (child.used_addresses or 0)
+        children_status.append(child.status.value if child.status else "livre")
+        child_ranges.append((child_start, child_size, child_prefixlen, child.usado))
+
+    # Metades calculadas exibidas na hierarquia (ver HierarchyBuilder.calculated_halves)
+    if children and network.prefixlen < network.max_prefixlen:
+        half_prefixlen = network.prefixlen + 1
+        half_size = int(network.num_addresses) // 2
+        real_children = {(start, prefixlen) for start, _, prefixlen, _ in child_ranges}
+        for half_start in (int(network.network_address), int(network.network_address) + half_size):
+            if (half_start, half_prefixlen) in real_children:
+                continue
+            half_end = half_start + half_size
+            half_used = sum(
+                size for start, size, _, usado in child_ranges
+                if usado and start >= half_start and start + size <= half_end
+            )
+            children_status.append(status_from_usage(half_used, half_size))
+
+    return {
+        "used_addresses": used_addresses,
+        "child_count": len(children),
+        "child_addresses": child_addresses,
+        "status": PrefixStatus(calculate_status_from_children(prefix, children_status)),
+    }
+
+
+IN_CHUNK_SIZE = 500
+
+def query_in(db: Session, column, values: Iterable, entities=(IPPrefix,)) -> list:
+    """Linhas cujo column está em values, em consultas IN de tamanho limitado"""
+    values = list(values)
+    result = []
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        result.extend(db.query(*entities).filter(column.in_(values[start:start + IN_CHUNK_SIZE])).all())
+    return result
+
+
+def locked_prefixes(db: Session, prefix_ids: Iterable[int]) -> List[IPPrefix]:
+    """Prefixos com lock de linha (SELECT ... FOR UPDATE, em ordem de id para evitar deadlocks)"""
+    prefix_ids = sorted(prefix_ids)
+    result = []
+    for start in range(0, len(prefix_ids), IN_CHUNK_SIZE):
+        result.extend(db.query(IPPrefix).filter(
+            IPPrefix.id.in_(prefix_ids[start:start + IN_CHUNK_SIZE])
+        ).order_by(IPPrefix.id).with_for_update().populate_existing().all())
+    return result
+
+
+def refresh_rollups(db: Session, prefix_ids: Iterable[int]):
+    """Recalcula os rollups dos prefixos informados e de todos os seus ancestrais.
+
+    Processa nível a nível: o último recálculo de cada ancestral sempre
+    acontece depois do último recálculo de todos os seus descendentes. Cada
+    nível carrega os prefixos (com lock de linha) e seus filhos diretos em lote.
+    """
+    write_locks.lock_rollups(db)
+    db.flush()
+    frontier = {prefix_id for prefix_id in prefix_ids if prefix_id is not None}
+
+    while frontier:
+        children: Dict[int, List[IPPrefix]] = defaultdict(list)
+        for child in query_in(db, IPPrefix.parent_id, frontier, CHILD_COLUMNS):
+            children[child.parent_id].append(child)
+
+        parents = set()
+        for prefix in locked_prefixes(db, frontier):
+            try:
+                values = compute_rollup(prefix, children[prefix.id])
+            except ValueError:
+                continue
+            for column, value in values.items():
+                setattr(prefix, column, value)
+            if prefix.parent_id is not None:
+                parents.add(prefix.parent_id)
+        db.flush()
+        frontier = parents
+
+
+def rebuild_all_rollups(db: Session) -> int:
+    """Recalcula os rollups de toda a tabela em memória (backfill/reparo)"""
+    prefixes = db.query(IPPrefix).all()
+    by_id: Dict[int, IPPrefix] = {p.id: p for p in prefixes}
+    children: Dict[int, List[IPPrefix]] = defaultdict(list)
+    for prefix in prefixes:
+        if prefix.parent_id in by_id:
+            children[prefix.parent_id].append(prefix)
+
+    # Pós-ordem iterativa a partir dos topos (sem pai carregado)
+    order = []
+    stack = [p for p in prefixes if p.parent_id not in by_id]
+    while stack:
+        prefix = stack.pop()
+        order.append(prefix)
+        stack.extend(children[prefix.id])
+
+    updated = 0
+    for prefix in reversed(order):
+        try:
+            values = compute_rollup(prefix, children[prefix.id])
+        except ValueError:
+            continue
+        for column, value in values.items():
+            setattr(prefix, column, value)
+        updated += 1
+
+    db.flush()
+    return updated
@@ -96,6 +96,7 @@ class SubnetResponse(BaseModel):
     id: Optional[int] = None  # ID se for real
     parent_id: Optional[int] = None
     children: List['SubnetResponse'] = []
+    children_count: int = 0  # Nº total de filhos, mesmo quando não expandidos (depth)
     total_addresses: int
     used_addresses: int
     available_addresses: int
@@ -109,4 +110,57 @@ class DivideResponse(BaseModel):
     subnets: List[IPPrefixResponse]
     message: str
 
+class LookupRequest(BaseModel):
+    addresses: List[str]  # Endereços IPv4/IPv6 (até MAX_LOOKUP_ADDRESSES)
+
+class LookupPrefix(BaseModel):
+    id: int
+    prefix: str
+    description: str
+    usado: bool
+
+class LookupResult(BaseModel):
+    address: str
+    prefix: Optional[LookupPrefix] = None  # Prefixo mais específico que contém o endereço
+    error: Optional[str] = None
+
+class LookupResponse(BaseModel):
+    results: List[LookupResult]
+
+class AllocateRequest(BaseModel):
+    prefixlen: int  # Tamanho da máscara dos blocos a reservar
+    count: int = 1
+    strategy: str = "first"  # "first" (menor endereço) ou "best" (menor bloco livre que comporta)
+    description: Optional[str] = None
+    usado: bool = False
+
+class AllocateResponse(BaseModel):
+    prefixes: List[IPPrefixResponse]
+    message: str
+
+class JobResponse(BaseModel):
+    id: str
+    kind: str
+    status: str  # "queued", "running", "done" ou "failed"
+    processed: int = 0
+    total: Optional[int] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: datetime
+    finished_at: Optional[datetime] = None
+
+class BulkImportRowResult(BaseModel):
+    row: int  # Posição da linha no payload (a partir de 1)
+    prefix: str
+    status: str  # "created", "exists" ou "error"
+    id: Optional[int] = None
+    parent_id: Optional[int] = None
+    detail: Optional[str] = None
+
+class BulkImportResponse(BaseModel):
+    created: int
+    existing: int
+    errors: int
+    results: List[BulkImportRowResult]
+
 SubnetResponse.model_rebuild()
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+Cache em memória de resultados calculados, indexado pela versão dos dados.
+
+A versão (tabela data_version) é incrementada por todo endpoint que altera
+prefixos; um resultado só é reaproveitado enquanto a versão não muda. Ao
+guardar o primeiro resultado de uma versão nova os das versões anteriores são
+descartados, e o total guardado é limitado em entradas e em bytes.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+from sqlalchemy.orm import Session
+from models import DataVersion
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "64"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def get_data_version(db: Session) -> int:
+    """Versão atual dos dados de prefixos"""
+    return db.query(DataVersion.version).filter(DataVersion.id == 1).scalar() or 0
+
+
+def bump_data_version(db: Session):
+    """Incrementa a versão dos dados na transação corrente (chamar antes do commit).
+
+    A versão resultante e quantos incrementos a transação fez ficam em db.info
+    ("data_version", "data_version_bumps") para os caches aplicarem o commit.
+    """
+    db.query(DataVersion).filter(DataVersion.id == 1).update(
+        {DataVersion.version: DataVersion.version + 1}, synchronize_session=False
+    )
+    db.info["data_version"] = get_data_version(db)
+    db.info["data_version_bumps"] = db.info.get("data_version_bumps", 0) + 1
+
+
+def version_etag(version: int) -> str:
+    return f'W/"v{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Compara o header If-None-Match com a ETag atual"""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+class VersionedCache:
+    """LRU limitado de (chave -> resultado) com os resultados de uma única versão dos dados"""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._version: Optional[int] = None
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()  # chave -> (resultado, bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: Hashable, version: int, compute: Callable[[], Any],
+                       size: Optional[Callable[[Any], int]] = None) -> Any:
+        """Resultado em cache para (chave, versão) ou calculado agora.
+
+        size(resultado) dá os bytes ocupados (sem ele conta 0); resultados maiores
+        que max_bytes são devolvidos sem entrar no cache.
+        """
+        with self._lock:
+            entry = self._entries.get(key) if version == self._version else None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+
+        value = compute()
+        value_bytes = size(value) if size else 0
+
+        with self._lock:
+            if self._version is not None and version < self._version:
+                # Calculado sobre dados que outra requisição já viu mudar
+                return value
+            if version != self._version:
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+            if value_bytes > self.max_bytes:
+                return value
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, value_bytes)
+            self._bytes += value_bytes
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+result_cache = VersionedCache()